@@ -68,6 +68,7 @@ if (isset($_POST['docket_number'])) {
         $id = add_opinion($db, $_POST);
         $db->exec('BEGIN TRANSACTION');
         add_concurrences($db, $id, $concurrences);
+        mark_reviewed($db, $docket_number);
         $db->exec('COMMIT TRANSACTION');
 
         // header($_SERVER['SERVER_PROTOCOL'] . ' 201 Created');
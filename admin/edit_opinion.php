@@ -71,6 +71,8 @@ if (isset($_POST['id'])) {
         $db->exec('BEGIN TRANSACTION');
         update_opinion($db, $_POST);
         update_concurrences($db, $id, $new_concurrences, $old_concurrences);
+        $edited_opinion = get_opinion($db, $id);
+        mark_reviewed($db, $edited_opinion['docket_number']);
         $db->exec('COMMIT TRANSACTION');
     }
 } else if (isset($_GET['id'])) {
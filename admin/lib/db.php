@@ -10,7 +10,26 @@ function connect($db_file = null) {
     if (is_null($db_file)) {
         $db_file = dirname(dirname(__DIR__)) . '/.db';
     }
-    return new SQLite3($db_file);
+    $db = new SQLite3($db_file);
+    // The CLI keeps the database in WAL mode, so reads don't block on a
+    // running sync; writes wait for it instead of failing right away.
+    $db->busyTimeout(5000);
+    return $db;
+}
+
+/**
+ * Records that a reviewer corrected the opinions of a case filing, so that
+ * `python -m cli reparse` leaves them alone.
+ *
+ * @param \SQLite3 $db The database connection.
+ * @param string   $docket_number The docket number of the case filing.
+ */
+function mark_reviewed(SQLite3 $db, $docket_number) {
+    $stmt = $db->prepare(
+        'UPDATE case_filings SET reviewed_on = CURRENT_TIMESTAMP WHERE docket_number = :docket_number'
+    );
+    $stmt->bindValue(':docket_number', $docket_number);
+    $stmt->execute();
 }
 
 /**
@@ -1,157 +1,342 @@
 # encoding=utf8
+"""Command line interface; see `python -m cli --help`.
+
+Each command only imports the modules it needs, so that e.g. `chart`
+doesn't load requests or set up an HTTP session. Without a command,
+`run` is assumed.
+"""
 from __future__ import print_function
 
-import apsw
-import unicodecsv as csv  # This helps fix unicode issues.
-import sqlite3
+import argparse
+from datetime import datetime
+import itertools
 import sys
 
-# import click as cli
-
-import chart
 import db
-from .http import (
-    DOCKET_LIST_ENDPOINT, DOCKET_LIST_FILTERS,
-    filters_to_url_params, get_response_json, start_http_session
-)
-from .models import CaseFiling, Justice, OpinionType
-import regex
+import metrics
 import utils
 
 
 def init():
-    db_connection = db.connect()
+    """Creates the database if it doesn't exist, brings it up to date
+    and populates the justices and opinion types. Safe to run again.
+    """
+    from .models import Justice, OpinionType
+
+    if not db.exists():
+        db.init()
+    db.migrate()
+    db_connection = db.connection()
+    utils.log('Populating table `justices`')
+    # Load justices from CSV config file and populate the justice table.
+    Justice.populate(db_connection)
+    utils.log('Populating table `opinion_types`')
+    OpinionType.populate(db_connection)
+
+
+def sync(args):
+    import sync
+
+    sync.run(args.concurrency, args.batch_size, args.processes)
+
+
+def import_bulk(args):
+    import bulk
+
+    bulk.run(args.dockets, args.clusters, args.opinions, args.court,
+             args.since, args.batch_size, args.processes)
+
+
+def reparse(args):
+    import reparse
+
+    reparse.run(args.apply, args.processes, args.batch_size)
+
+
+def chart(args):
+    import chart
+    import date
+
+    if args.verify:
+        if not chart.verify():
+            sys.exit(1)
+        return
+    formats = args.format or chart.DEFAULT_FORMATS
+    start_date, end_date = args.start, args.end
+    if args.monthly:
+        start_date = start_date or date.DEFAULT_START_DATE
+        end_date = end_date or date.date_to_str(datetime.now())
+    if start_date and end_date and start_date > end_date:
+        sys.exit('The chart would end ({}) before it starts ({})'
+                 .format(end_date, start_date))
+    if args.monthly:
+        chart.build_windows(date.month_windows(start_date, end_date), formats)
+    else:
+        chart.build(start_date, end_date, formats)
+
+
+def daemon(args):
+    import chart
+    import daemon
+
+    cycles = itertools.count(1)
+
+    def after_cycle():
+        # Each cycle's metrics are written on their own, rather than
+        # adding up from one cycle to the next.
+        _write_metrics(args, cycle=next(cycles))
+        metrics.reset()
+
+    daemon.run(args.concurrency, args.batch_size, args.processes,
+               args.format or chart.DEFAULT_FORMATS, args.monthly,
+               args.poll_interval * 60, args.poll_window * 60,
+               after_cycle=after_cycle)
+
+
+def search(args):
+    import search
+
     try:
-        utils.log('Populating table `justices`')
-        # Load justices from CSV config file and populate the justice table.
-        justices_path = utils.project_path('config', 'justices.csv')
-        with db_connection, open(justices_path, 'rb') as justices_csv:
-            justices_reader = csv.DictReader(justices_csv)
-            # TODO: change?
-            for row in justices_reader:
-                justice = Justice(row['shorthand'], row['short_name'],
-                                  row['fullname'])
-                try:
-                    justice.insert(db_connection)
-                except apsw.ConstraintError as e:
-                    msg = 'Unable to insert {}: {}'
-                    utils.warn(msg, justice, e)
-        # Populate the opinion type table.
-        utils.log('Populating table `opinion_types`')
-        opinion_types_sql = 'INSERT INTO opinion_types (type) VALUES (?);'
-        with db_connection:
-            try:
-                db_connection.cursor().executemany(
-                    opinion_types_sql,
-                    [(str(op_type),) for op_type in list(OpinionType)]
-                )
-            except apsw.ConstraintError as e:
-                msg = 'Unable to populate table `opinion_types`: {}'
-                utils.warn(msg, e)
-    finally:
-        db_connection.close()
+        results = search.search(db.connection(), args.query, args.limit)
+    except ValueError as e:
+        sys.exit(str(e))
+    for result in results:
+        print('{docket_number}\t{filed_on}\t{snippet}'.format(**result))
+    if not results:
+        utils.log('No matches')
+
+
+def serve(args):
+    import api
+
+    api.serve(args.host, args.port)
 
 
-def main():
-    # TODO: for future use
-    flagged_cases = set()
+def bench(args):
+    import json
+
+    import bench
+
+    results = bench.run(args.size, args.seed, args.repeat, not args.no_sync)
+    output = args.output or utils.project_path(
+        'out', 'bench_{}.json'.format(datetime.now().strftime('%Y-%m-%d_%H%M%S'))
+    )
+    bench.save(results, output)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if bench.compare(results, baseline, args.threshold):
+            sys.exit(1)
+    else:
+        bench.report(results)
+
+
+def run(args):
+    init()
+    sync(args)
+    chart(args)
 
-    def flag(case_filing, msg):
-        flagged_cases.add(case_filing)
-        utils.log(msg, case_filing)
 
-    http_session = start_http_session()
+def _parser():
+    from .date import DEFAULT_START_DATE
+    from .export import WRITERS
+    from .http import DEFAULT_CONCURRENCY
+    from .ingest import DEFAULT_BATCH_SIZE
+
+    parser = argparse.ArgumentParser(prog='python -m cli')
+    parser.add_argument('--db', metavar='PATH',
+                        help='database file (default: $DB_FILE or .db)')
+    parser.add_argument('--metrics-json', metavar='PATH',
+                        help='append stage timings and counters to PATH as '
+                             'JSON lines ("-" for stdout)')
+    parser.add_argument('--metrics-textfile', metavar='PATH',
+                        help='write stage timings and counters to PATH in '
+                             'the Prometheus text format')
+    parser.add_argument('--profile', metavar='STAGE', action='append',
+                        help='profile STAGE (e.g. insert_case) with cProfile '
+                             'into out/profile_STAGE.prof; may be repeated')
+    commands = parser.add_subparsers(title='commands', dest='command_name')
+
+    sync_options = argparse.ArgumentParser(add_help=False)
+    sync_options.add_argument('--concurrency', type=int,
+                              default=DEFAULT_CONCURRENCY,
+                              help='pages of the docket fetched at the same '
+                                   'time')
+    sync_options.add_argument('--batch-size', type=int,
+                              default=DEFAULT_BATCH_SIZE,
+                              help='case filings written per transaction')
+    sync_options.add_argument('--processes', type=int,
+                              help='opinion parsing processes '
+                                   '(default: one per CPU)')
+
+    chart_options = argparse.ArgumentParser(add_help=False)
+    chart_options.add_argument('--start', metavar='YYYY-MM-DD',
+                               help='first filing date to chart')
+    chart_options.add_argument('--end', metavar='YYYY-MM-DD',
+                               help='last filing date to chart')
+    chart_options.add_argument('--format', action='append',
+                               choices=sorted(WRITERS),
+                               help='output format, may be repeated '
+                                    '(default: html)')
+    chart_options.add_argument('--monthly', action='store_true',
+                               help='build one chart per month')
+    chart_options.add_argument('--verify', action='store_true',
+                               help='check the materialized agreement '
+                                    'counts instead of building charts')
+
+    command = commands.add_parser(
+        'init', help='create or upgrade the database')
+    command.set_defaults(command=lambda args: init(), needs_db=False)
+    command = commands.add_parser(
+        'sync', parents=[sync_options],
+        help='sync the active docket from CourtListener')
+    command.set_defaults(command=sync, needs_db=True)
+    command = commands.add_parser(
+        'import', help='import case filings from CourtListener bulk data '
+                       'tarballs, offline')
+    command.add_argument('--dockets', metavar='TARBALL', required=True)
+    command.add_argument('--clusters', metavar='TARBALL', required=True)
+    command.add_argument('--opinions', metavar='TARBALL', required=True)
+    command.add_argument('--court', default='cal',
+                         help='court whose dockets to import (default: cal)')
+    command.add_argument('--since', metavar='YYYY-MM-DD',
+                         default=DEFAULT_START_DATE,
+                         help='first filing date to import (default: {})'
+                              .format(DEFAULT_START_DATE))
+    command.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                         help='case filings written per transaction')
+    command.add_argument('--processes', type=int,
+                         help='opinion parsing processes '
+                              '(default: one per CPU)')
+    command.set_defaults(command=import_bulk, needs_db=True)
+    command = commands.add_parser(
+        'reparse', help='parse the stored opinion texts again, and list '
+                        'how their opinions differ from the stored ones')
+    command.add_argument('--apply', action='store_true',
+                         help='also write the differences, except to case '
+                              'filings corrected by reviewers')
+    command.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                         help='case filings parsed and written per '
+                              'transaction')
+    command.add_argument('--processes', type=int,
+                         help='opinion parsing processes '
+                              '(default: one per CPU)')
+    command.set_defaults(command=reparse, needs_db=True)
+    command = commands.add_parser(
+        'chart', parents=[chart_options], help='build agreement charts')
+    command.set_defaults(command=chart, needs_db=True)
+    command = commands.add_parser(
+        'run', parents=[sync_options, chart_options],
+        help='init, sync and chart')
+    command.set_defaults(command=run, needs_db=False)
+    command = commands.add_parser(
+        'daemon', parents=[sync_options],
+        help='sync and chart whenever opinions are posted, until '
+             'interrupted')
+    command.add_argument('--format', action='append', choices=sorted(WRITERS),
+                         help='output format, may be repeated '
+                              '(default: html)')
+    command.add_argument('--monthly', action='store_true',
+                         help='also rebuild the monthly charts')
+    command.add_argument('--poll-interval', metavar='MINUTES', type=float,
+                         default=5,
+                         help='time between polls after a posting time '
+                              '(default: 5)')
+    command.add_argument('--poll-window', metavar='MINUTES', type=float,
+                         default=180,
+                         help='how long to poll for after a posting time '
+                              '(default: 180)')
+    command.set_defaults(command=daemon, needs_db=True)
+    command = commands.add_parser(
+        'search', help='search the opinion texts, best matches first')
+    command.add_argument('query',
+                         help='FTS5 query: words, "phrases", prefix*, '
+                              'AND, OR, NOT and NEAR()')
+    command.add_argument('--limit', type=int, default=20,
+                         help='most case filings to list (default: 20)')
+    command.set_defaults(command=search, needs_db=True)
+    command = commands.add_parser(
+        'serve', help='serve a read-only JSON API over the database, for '
+                      'the admin interface')
+    command.add_argument('--host', default='127.0.0.1',
+                         help='address to listen on (default: 127.0.0.1)')
+    command.add_argument('--port', type=int, default=8765,
+                         help='port to listen on (default: 8765)')
+    command.set_defaults(command=serve, needs_db=True)
+    command = commands.add_parser(
+        'bench', help='benchmark parsing, ingest, charts and syncs over a '
+                      'synthetic corpus')
+    command.add_argument('--size', type=int, default=2000,
+                         help='case filings in the corpus (default: 2000)')
+    command.add_argument('--seed', type=int, default=0,
+                         help='seed of the corpus (default: 0)')
+    command.add_argument('--repeat', type=int, default=3,
+                         help='runs of each benchmark, of which the fastest '
+                              'counts (default: 3)')
+    command.add_argument('--no-sync', action='store_true',
+                         help='skip the end-to-end sync benchmark')
+    command.add_argument('--output', metavar='PATH',
+                         help='where to save the results as JSON '
+                              '(default: out/bench_<timestamp>.json)')
+    command.add_argument('--compare', metavar='BASELINE',
+                         help='results to compare with; exits with 1 on '
+                              'regressions')
+    command.add_argument('--threshold', type=float, default=0.1,
+                         help='slowdown that counts as a regression '
+                              '(default: 0.1)')
+    command.set_defaults(command=bench, needs_db=False)
+    return parser, commands.choices
+
+
+def main(argv=None):
+    parser, command_names = _parser()
+    args = parser.parse_args(_with_command(
+        sys.argv[1:] if argv is None else argv, command_names
+    ))
+    if args.db:
+        db.set_path(args.db)
+    if args.needs_db:
+        if not db.exists():
+            parser.error('no database; run `python -m cli init` first')
+        db.migrate()
+    metrics.enable_profiling(args.profile)
     try:
-        db_connection = db.connect()
-        try:
-            for case_filing in get_active_docket(http_session):
-                inserted_opinions = insert_case(db_connection, case_filing)
-                if inserted_opinions is not None and len(inserted_opinions):
-                    insert_concurrences(db_connection, inserted_opinions)
-        finally:
-            db_connection.close()
+        args.command(args)
     finally:
-        http_session.close()
+        db.close()
+        # The daemon writes its metrics after each cycle.
+        if args.command_name != 'daemon':
+            _write_metrics(args)
 
 
-def get_active_docket(http_session):
-    utils.log('Fetching active docket...')
-    next_page = DOCKET_LIST_ENDPOINT \
-                + filters_to_url_params(DOCKET_LIST_FILTERS)
-    while next_page:
-        utils.log('Fetching {}', next_page)
-        response = get_response_json(http_session.get(next_page))
-        for docket_entry in response['results']:
-            yield CaseFiling(docket_entry, http_session)
-        next_page = response.get('next')
+def _with_command(argv, command_names):
+    """Returns ARGV, with `run` added if it has none of COMMAND_NAMES.
+    The options before the command all take a value, which is skipped.
+    """
+    args = iter(argv)
+    for arg in args:
+        if arg in command_names:
+            return argv
+        if arg.startswith('--') and '=' not in arg and arg != '--help':
+            next(args, None)
+    return list(argv) + ['run']
 
 
-def insert_case(db_connection, case_filing):
-    # Begin and commit transaction for inserting the case
-    # filing and its opinions.
-    inserted_opinions = []
-    try:
-        with db_connection:
-            case_filing.insert(db_connection)
-            for opinion in case_filing.opinions:
-                # Case Filing has no opinions.
-                if opinion is None:
-                    break
-                if opinion.insert(db_connection):
-                    inserted_opinions.append(opinion)
-    except (apsw.Error, sqlite3.Error) as e:
-        msg = 'Unable to insert {}: {}'
-        utils.warn(msg, case_filing.docket_number, e)
-        # Case filing and opinions not inserted, so no
-        # concurrences to insert.
-        return None
-    return inserted_opinions
-
-
-def insert_concurrences(db_connection, opinions):
-    assert len(opinions), 'There should always be at least one opinion (majority).'
-    # Insert concurrences.
-    sql = """
-        INSERT INTO concurrences (
-            opinion_id,
-            justice
-        )
-        VALUES (?, ?);
+def _write_metrics(args, cycle=None):
+    """Writes the metrics collected by the command as asked by ARGS,
+    even if the command failed. The JSON lines of a daemon's CYCLE are
+    labelled with it.
     """
-    concurrences = []
-    for op in opinions:
-        # Insert a concurrence row for each concurring justice.
-        for concurring_justice_name in op.concurring_justices:
-            concurring_justice = Justice.get(concurring_justice_name)
-            # TODO: move this to Opinion constructor?
-            if concurring_justice is None:
-                # See if we missed justices due to bad formatting
-                # E.g., a missing comma between names
-                justice_names, unknown_name = regex.findall_and_reduce(
-                    Justice.all_short_names(),
-                    concurring_justice_name
-                )
-                if justice_names:
-                    # Add the newly discovered concurring justices to
-                    # the opinion so that this loop will come back to them.
-                    op.concurring_justices.extend(justice_names)
-                if unknown_name:
-                    # Part or all of the unknown name remains
-                    msg = "Unknown concurring justice '{}'"
-                    utils.warn(msg, concurring_justice_name)
-                continue
-            concurrences.append((op.id, concurring_justice.shorthand))
-    assert len(concurrences), 'There are no concurrences; the majority opinion always has some.'
-    utils.log('Inserting concurrences: {}', ', '.join(c[1] for c in concurrences))
-    try:
-        with db_connection:
-            db_connection.cursor().executemany(sql, concurrences)
-    except apsw.ConstraintError as e:
-        utils.warn(str(e))
-    except (apsw.Error, sqlite3.Error) as e:
-        msg = 'Could not insert concurrences for {}: {}'
-        docket_number = opinions[0].case_filing.docket_number
-        utils.warn(msg, docket_number, e)
+    if args.metrics_json:
+        labels = {'command': args.command_name}
+        if cycle is not None:
+            labels['cycle'] = cycle
+        metrics.write_json(args.metrics_json, **labels)
+    if args.metrics_textfile:
+        metrics.write_textfile(args.metrics_textfile,
+                               command=args.command_name)
+    if args.profile:
+        metrics.write_profiles(utils.project_path('out'))
 
 
 if __name__ == '__main__':
@@ -160,6 +345,4 @@ if __name__ == '__main__':
     reload(sys)
     sys.setdefaultencoding('utf8')
 
-    init()
-    main()
-    chart.build()
+    main(sys.argv[1:])
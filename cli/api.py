@@ -0,0 +1,429 @@
+"""Read-only JSON API over the database, served by `python -m cli serve`
+for the admin interface.
+
+Lists are paginated by keyset rather than by offset: each page links to
+the next one with an opaque `after` cursor, so a page costs the same
+however deep it is. A page of case filings or opinions is fetched with
+one query for the page and one JOIN for the opinions and concurrences
+of the whole page, rather than a query per row, and `count` is a
+COUNT(*). Every response has an ETag, so that unchanged ones can be
+revalidated without being sent again.
+
+Endpoints, under /api:
+- /case_filings[?flagged=1], /case_filings/<docket number>
+- /opinions[?flagged=1], /opinions/<id>
+- /concurrences[?justice=<shorthand>]
+- /flags: number of case filings and opinions with each flag
+- /search?q=<FTS5 query>: case filings whose opinion text matches, best
+  first, with snippets
+- /justices, /opinion_types
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import base64
+from collections import OrderedDict
+import hashlib
+import json
+import re
+from SocketServer import ThreadingMixIn
+import threading
+import traceback
+import urllib
+import urlparse
+
+import apsw
+
+import db
+import search
+import utils
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# Results per page, unless the `limit` parameter says otherwise.
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+# Aliased, as SQLite may name columns otherwise after flattening queries.
+_CASE_FILING_COLUMNS = """
+    cf.docket_number AS docket_number,
+    cf.url AS url,
+    cf.sha1 AS sha1,
+    cf.filed_on AS filed_on,
+    cf.added_on AS added_on,
+    cf.modified_on AS modified_on,
+    cf.updated_on AS updated_on,
+    cf.reviewer AS reviewer,
+    cf.reviewed_on AS reviewed_on,
+    cf.ends_in_letter_flag AS ends_in_letter_flag,
+    cf.no_opinions_flag AS no_opinions_flag,
+    cf.exclude_from_chart AS exclude_from_chart
+"""
+_OPINION_COLUMNS = """
+    o.id AS id,
+    o.docket_number AS docket_number,
+    o.type_id AS type_id,
+    o.effective_type_id AS effective_type_id,
+    o.authoring_justice AS authoring_justice,
+    o.unknown_author_flag AS unknown_author_flag,
+    o.unknown_concur_flag AS unknown_concur_flag,
+    o.no_concurrences_flag AS no_concurrences_flag,
+    o.effective_type_flag AS effective_type_flag
+"""
+_CASE_FILING_FLAGS = ('ends_in_letter_flag', 'no_opinions_flag')
+_OPINION_FLAGS = ('unknown_author_flag', 'unknown_concur_flag',
+                  'no_concurrences_flag', 'effective_type_flag')
+# As on the admin interface's index.
+_FLAGGED_CASE_FILINGS = 'cf.ends_in_letter_flag = 1 OR cf.no_opinions_flag = 1'
+_FLAGGED_OPINIONS = 'o.no_concurrences_flag = 1 OR o.effective_type_flag = 1'
+
+
+class ApiError(Exception):
+    def __init__(self, status, detail):
+        super(ApiError, self).__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+class ApiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """Serves the API on PORT of HOST, or any free port if 0."""
+        HTTPServer.__init__(self, (host, port), _ApiRequestHandler)
+        self.base_url = 'http://{}:{}'.format(*self.server_address[:2])
+
+    def start(self):
+        """Serves requests in a background thread until shutdown()."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Serves the API until interrupted."""
+    server = ApiServer(host, port)
+    utils.log('Serving the API at {}/api/', server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# Request handlers, by path. Each takes the database connection, the
+# query parameters and the path's groups, and returns what to respond.
+_ROUTES = []
+
+
+def _route(pattern):
+    def register(handler):
+        _ROUTES.append((re.compile('^/api' + pattern + '$'), handler))
+        return handler
+    return register
+
+
+class _ApiRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Buffer each response so that it is sent in one go.
+    wbufsize = -1
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        query = urlparse.parse_qs(url.query)
+        try:
+            for pattern, handler in _ROUTES:
+                match = pattern.match(url.path)
+                if match:
+                    groups = [urllib.unquote(g) for g in match.groups()]
+                    body = handler(_read_only_connection(), query, *groups)
+                    break
+            else:
+                raise ApiError(404, 'Not found.')
+        except ApiError as e:
+            self._respond(e.status, {'detail': e.detail})
+            return
+        except Exception:
+            utils.warn('Failed to respond to {}:\n{}', self.path,
+                       traceback.format_exc())
+            self._respond(500, {'detail': 'Internal error.'})
+            return
+        finally:
+            # Request threads don't outlive their request.
+            db.close()
+        if isinstance(body, dict) and body.get('next'):
+            body['next'] = url.path + body['next']
+        self._respond(200, body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, body):
+        content = json.dumps(body, sort_keys=True)
+        etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+        if_none_match = self.headers.get('If-None-Match', '')
+        if status == 200 and etag in [tag.strip()
+                                      for tag in if_none_match.split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        if status == 200:
+            self.send_header('ETag', etag)
+            # May be cached, but must be revalidated.
+            self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+
+@_route(r'/case_filings/?')
+def list_case_filings(db_connection, query):
+    where = _FLAGGED_CASE_FILINGS if _flag_param(query, 'flagged') else '1'
+    limit = _limit_param(query)
+    after = _cursor_param(query, 2)
+    bindings = []
+    keyset = ''
+    if after is not None:
+        # Newest first, as on the admin interface.
+        # Row values need SQLite 3.15, so the comparison is spelled out,
+        # with a bound on filed_on for the index to seek to.
+        keyset = ('AND cf.filed_on <= ? AND '
+                  '(cf.filed_on < ? OR cf.docket_number < ?)')
+        bindings.extend([after[0], after[0], after[1]])
+    sql = """
+        SELECT {}
+        FROM case_filings cf
+        WHERE ({}) {}
+        ORDER BY cf.filed_on DESC, cf.docket_number DESC
+        LIMIT ?;
+    """.format(_CASE_FILING_COLUMNS, where, keyset)
+    case_filings = _fetch_all(db_connection, sql, bindings + [limit])
+    _add_opinions(db_connection, case_filings)
+    next_cursor = None
+    if len(case_filings) == limit:
+        last = case_filings[-1]
+        next_cursor = [last['filed_on'], last['docket_number']]
+    return _page(db_connection, 'case_filings cf', where, case_filings,
+                 query, next_cursor)
+
+
+@_route(r'/case_filings/([^/]+)/?')
+def get_case_filing(db_connection, query, docket_number):
+    sql = """
+        SELECT {}
+        FROM case_filings cf
+        WHERE cf.docket_number = ?;
+    """.format(_CASE_FILING_COLUMNS)
+    case_filings = _fetch_all(db_connection, sql, (docket_number,))
+    if not case_filings:
+        raise ApiError(404, 'No case filing {}.'.format(docket_number))
+    _add_opinions(db_connection, case_filings)
+    return case_filings[0]
+
+
+@_route(r'/opinions/?')
+def list_opinions(db_connection, query):
+    where = _FLAGGED_OPINIONS if _flag_param(query, 'flagged') else '1'
+    limit = _limit_param(query)
+    after = _cursor_param(query, 1)
+    opinions = _fetch_opinions(
+        db_connection,
+        '({}) AND o.id > ? ORDER BY o.id LIMIT ?'.format(where),
+        (after[0] if after is not None else -1, limit)
+    )
+    next_cursor = [opinions[-1]['id']] if len(opinions) == limit else None
+    return _page(db_connection, 'opinions o', where, opinions, query,
+                 next_cursor)
+
+
+@_route(r'/opinions/(\d+)/?')
+def get_opinion(db_connection, query, id_):
+    opinions = _fetch_opinions(db_connection, 'o.id = ?', (int(id_),))
+    if not opinions:
+        raise ApiError(404, 'No opinion {}.'.format(id_))
+    return opinions[0]
+
+
+@_route(r'/concurrences/?')
+def list_concurrences(db_connection, query):
+    where = '1'
+    bindings = []
+    if 'justice' in query:
+        where = 'c.justice = ?'
+        bindings.append(query['justice'][0])
+    limit = _limit_param(query)
+    after = _cursor_param(query, 1)
+    sql = """
+        SELECT c.id, c.opinion_id, o.docket_number, c.justice
+        FROM concurrences c
+        JOIN opinions o ON o.id = c.opinion_id
+        WHERE ({}) AND c.id > ?
+        ORDER BY c.id
+        LIMIT ?;
+    """.format(where)
+    concurrences = _fetch_all(db_connection, sql, bindings + [
+        after[0] if after is not None else -1, limit
+    ])
+    next_cursor = [concurrences[-1]['id']] \
+        if len(concurrences) == limit else None
+    return _page(db_connection, 'concurrences c', where, concurrences,
+                 query, next_cursor, bindings)
+
+
+@_route(r'/flags/?')
+def count_flags(db_connection, query):
+    case_filings = _fetch_all(db_connection, 'SELECT {} FROM case_filings;'
+                              .format(_totals(_CASE_FILING_FLAGS)))[0]
+    opinions = _fetch_all(db_connection, 'SELECT {} FROM opinions;'
+                          .format(_totals(_OPINION_FLAGS)))[0]
+    return {
+        'case_filings': {k: int(v) for k, v in case_filings.iteritems()},
+        'opinions': {k: int(v) for k, v in opinions.iteritems()},
+    }
+
+
+@_route(r'/search/?')
+def search_opinion_texts(db_connection, query):
+    if not query.get('q', [''])[0].strip():
+        raise ApiError(400, 'q is required.')
+    q = query['q'][0].decode('utf8')
+    try:
+        results = search.search(db_connection, q, _limit_param(query))
+    except ValueError as e:
+        raise ApiError(400, str(e))
+    return {'query': q, 'results': results}
+
+
+@_route(r'/justices/?')
+def list_justices(db_connection, query):
+    return _fetch_all(
+        db_connection,
+        'SELECT shorthand, short_name, fullname FROM justices ORDER BY rowid;'
+    )
+
+
+@_route(r'/opinion_types/?')
+def list_opinion_types(db_connection, query):
+    return _fetch_all(db_connection,
+                      'SELECT id, type FROM opinion_types ORDER BY id;')
+
+
+def _read_only_connection():
+    db_connection = db.connection()
+    db_connection.cursor().execute('PRAGMA query_only = ON;')
+    return db_connection
+
+
+def _add_opinions(db_connection, case_filings):
+    """Sets the `opinions` of each of CASE_FILINGS, with one query."""
+    by_docket_number = OrderedDict()
+    for case_filing in case_filings:
+        case_filing['opinions'] = []
+        by_docket_number[case_filing['docket_number']] = case_filing
+    if not by_docket_number:
+        return
+    opinions = _fetch_opinions(
+        db_connection,
+        'o.docket_number IN ({}) ORDER BY o.id'.format(
+            ', '.join('?' * len(by_docket_number))
+        ),
+        list(by_docket_number)
+    )
+    for opinion in opinions:
+        by_docket_number[opinion['docket_number']]['opinions'].append(opinion)
+
+
+def _fetch_opinions(db_connection, condition, bindings):
+    """Returns the opinions that meet CONDITION (an SQL expression on
+    `o`, and its ORDER BY and LIMIT) with their concurring justices and
+    case filing URLs, from a single query.
+    """
+    sql = """
+        SELECT {}, cf.url AS url, c.justice AS concurring_justice
+        FROM (SELECT * FROM opinions o WHERE {}) o
+        JOIN case_filings cf ON cf.docket_number = o.docket_number
+        LEFT JOIN concurrences c ON c.opinion_id = o.id
+        ORDER BY o.id, c.id;
+    """.format(_OPINION_COLUMNS, condition)
+    opinions = []
+    for row in _fetch_all(db_connection, sql, bindings):
+        justice = row.pop('concurring_justice')
+        if not opinions or opinions[-1]['id'] != row['id']:
+            row['concurring_justices'] = []
+            opinions.append(row)
+        if justice is not None:
+            opinions[-1]['concurring_justices'].append(justice)
+    return opinions
+
+
+def _page(db_connection, table, where, results, query, next_cursor,
+          bindings=()):
+    """Returns a page of RESULTS of the list with the given QUERY, with
+    the COUNT(*) of the rows of TABLE that meet WHERE (given BINDINGS)
+    and the query string of the page after NEXT_CURSOR, if any.
+    """
+    cur = db_connection.cursor()
+    cur.execute('SELECT COUNT(*) FROM {} WHERE {};'.format(table, where),
+                bindings)
+    (count,) = cur.fetchone()
+    next_query = None
+    if next_cursor is not None:
+        next_query = dict(query, after=[_encode_cursor(next_cursor)])
+        next_query = '?' + urllib.urlencode(sorted(next_query.iteritems()),
+                                            doseq=True)
+    return {'count': count, 'next': next_query, 'results': results}
+
+
+def _totals(columns):
+    return ', '.join('TOTAL({0}) AS {0}'.format(column) for column in columns)
+
+
+def _fetch_all(db_connection, sql, bindings=()):
+    cur = db_connection.cursor()
+    cur.execute(sql, bindings)
+    try:
+        names = [name for name, _ in cur.getdescription()]
+    except apsw.ExecutionCompleteError:
+        # No rows.
+        return []
+    return [dict(zip(names, row)) for row in cur]
+
+
+def _flag_param(query, name):
+    return query.get(name, ['0'])[0] not in ('0', 'false', '')
+
+
+def _limit_param(query):
+    try:
+        limit = int(query.get('limit', [DEFAULT_LIMIT])[0])
+    except ValueError:
+        raise ApiError(400, 'limit must be an integer.')
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ApiError(400, 'limit must be from 1 to {}.'.format(MAX_LIMIT))
+    return limit
+
+
+def _cursor_param(query, length):
+    if 'after' not in query:
+        return None
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(query['after'][0]))
+    except (TypeError, ValueError):
+        cursor = None
+    if not isinstance(cursor, list) or len(cursor) != length:
+        raise ApiError(400, 'Invalid after cursor.')
+    return cursor
+
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values))
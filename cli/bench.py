@@ -0,0 +1,246 @@
+"""Benchmarks of opinion parsing, ingest, chart builds and end-to-end
+syncs over a synthetic corpus (see corpus.py), run by `python -m cli
+bench`.
+
+Each benchmark is run REPEAT times on a fresh database and its fastest
+run is reported. Results are saved as JSON, and may be compared with
+those of an earlier run to flag regressions.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import time
+
+import chart
+from .corpus import Corpus
+import db
+from .ingest import insert_case, insert_concurrences
+from .models import CaseFiling, Justice, OpinionType
+import regex
+from .stubserver import StubServer
+import utils
+
+
+DEFAULT_SIZE = 2000
+DEFAULT_SEED = 0
+DEFAULT_REPEAT = 3
+# A benchmark that is slower than its baseline by more than this
+# fraction is a regression.
+DEFAULT_THRESHOLD = 0.1
+
+# Directory containing the cli package, from which `python -m cli` runs.
+_PACKAGE_PARENT = utils.project_path('..')
+
+
+def run(size=DEFAULT_SIZE, seed=DEFAULT_SEED, repeat=DEFAULT_REPEAT,
+        sync=True):
+    """Runs every benchmark (the end-to-end sync only if SYNC) over a
+    corpus of SIZE case filings generated from SEED, and returns the
+    results.
+    """
+    utils.log('Generating a corpus of {} case filings', size)
+    corpus = Corpus(size, seed)
+    results = {
+        'meta': {
+            'size': size,
+            'seed': seed,
+            'repeat': repeat,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'started_at': datetime.now().isoformat(),
+        },
+        'benchmarks': {},
+    }
+    benchmarks = results['benchmarks']
+    work_dir = tempfile.mkdtemp(prefix='cli-bench-')
+    server = StubServer(corpus).start()
+    try:
+        benchmarks['findall_opinions'] = bench_findall_opinions(corpus, repeat)
+        benchmarks.update(bench_ingest(corpus, server, repeat, work_dir))
+        if sync:
+            benchmarks['sync'] = bench_sync(corpus, server, repeat, work_dir)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def bench_findall_opinions(corpus, repeat):
+    plain_texts = [cf['plain_text'] for cf in corpus.case_filings]
+
+    def findall_all():
+        for plain_text in plain_texts:
+            regex.findall_opinions(plain_text)
+
+    return _result('findall_opinions', len(plain_texts),
+                   [_timed(findall_all) for _ in range(repeat)])
+
+
+def bench_ingest(corpus, server, repeat, work_dir):
+    """Times insert_case() and insert_concurrences() over every case
+    filing of CORPUS, each in a single transaction, and chart.build()
+    on the resulting database.
+    """
+    import requests
+
+    utils.log('Fetching {} case filings from the stub server', corpus.size)
+    http_session = requests.Session()
+    with _quiet():
+        case_filings = [
+            CaseFiling(corpus.docket_entry(cf, server.base_url), http_session)
+            for cf in corpus.case_filings
+        ]
+    http_session.close()
+
+    timings = {'insert_case': [], 'insert_concurrences': [], 'chart_build': []}
+    for i in range(repeat):
+        run_dir = os.path.join(work_dir, 'ingest-{}'.format(i))
+        os.makedirs(os.path.join(run_dir, 'out'))
+        db_connection = _init_db(os.path.join(run_dir, 'bench.db'))
+        opinions = []
+
+        def insert_cases():
+            with db_connection:
+                for case_filing in case_filings:
+                    opinions.extend(insert_case(db_connection, case_filing)
+                                    or [])
+
+        def insert_all_concurrences():
+            insert_concurrences(db_connection, opinions)
+
+        def build_chart():
+            chart.build()
+
+        chart.OUT_PATH = os.path.join(run_dir, 'out')
+        with _quiet():
+            timings['insert_case'].append(_timed(insert_cases))
+            timings['insert_concurrences'].append(
+                _timed(insert_all_concurrences)
+            )
+            timings['chart_build'].append(_timed(build_chart))
+        db.close()
+    chart.OUT_PATH = utils.project_path('out')
+    return {
+        'insert_case': _result('insert_case', len(case_filings),
+                               timings['insert_case']),
+        'insert_concurrences': _result('insert_concurrences', len(opinions),
+                                       timings['insert_concurrences']),
+        'chart_build': _result('chart_build', len(case_filings),
+                               timings['chart_build']),
+    }
+
+
+def bench_sync(corpus, server, repeat, work_dir):
+    """Times `python -m cli sync` against SERVER into a fresh database,
+    with an empty HTTP cache and no rate limit.
+    """
+    env = dict(os.environ,
+               COURTLISTENER_BASE_URL=server.base_url,
+               COURTLISTENER_API_TOKEN='bench',
+               COURTLISTENER_REQUEST_BUDGET=str(10 ** 9))
+    timings = []
+    for i in range(repeat):
+        run_dir = os.path.join(work_dir, 'sync-{}'.format(i))
+        os.makedirs(run_dir)
+        db_path = os.path.join(run_dir, 'bench.db')
+        env['HTTP_CACHE_FILE'] = os.path.join(run_dir, 'cache.db')
+        _cli(env, '--db', db_path, 'init')
+        timings.append(_timed(lambda: _cli(env, '--db', db_path, 'sync')))
+    return _result('sync', corpus.size, timings)
+
+
+def save(results, path):
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+    utils.log('Saved benchmark results to "{}"', path)
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Logs how each benchmark of RESULTS compares with BASELINE, both
+    as returned by run(), and returns the names of the benchmarks that
+    are more than THRESHOLD slower.
+    """
+    if results['meta']['size'] != baseline['meta']['size']:
+        utils.warn('Comparing corpora of {} and {} case filings',
+                   results['meta']['size'], baseline['meta']['size'])
+    regressions = []
+    for name, result in sorted(results['benchmarks'].iteritems()):
+        baseline_result = baseline['benchmarks'].get(name)
+        if baseline_result is None:
+            utils.log('{}: {:.3f}s (no baseline)', name, result['seconds'])
+            continue
+        change = result['seconds'] / baseline_result['seconds'] - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        utils.log('{}: {:.3f}s (baseline {:.3f}s, {:+.1%}){}', name,
+                  result['seconds'], baseline_result['seconds'], change,
+                  ' REGRESSION' if regressed else '')
+    return regressions
+
+
+def report(results):
+    for name, result in sorted(results['benchmarks'].iteritems()):
+        utils.log('{}: {:.3f}s ({:.0f}/s)', name, result['seconds'],
+                  result['per_second'])
+
+
+def _init_db(path):
+    """Creates and populates a database at PATH, as `init` does, and
+    returns this thread's connection to it.
+    """
+    db.close()
+    db.set_path(path)
+    with _quiet():
+        db.init()
+        db.migrate()
+        db_connection = db.connection()
+        Justice.populate(db_connection)
+        OpinionType.populate(db_connection)
+    return db_connection
+
+
+def _cli(env, *args):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, '-m', 'cli'] + list(args),
+                              cwd=_PACKAGE_PARENT, env=env, stdout=devnull)
+
+
+def _timed(f):
+    start = time()
+    f()
+    return time() - start
+
+
+def _result(name, count, timings):
+    seconds = min(timings)
+    utils.log('{}: {:.3f}s', name, seconds)
+    return {
+        'seconds': seconds,
+        'runs': timings,
+        'count': count,
+        'per_second': count / seconds if seconds else None,
+    }
+
+
+@contextmanager
+def _quiet():
+    """Discards what is logged meanwhile, so that printing doesn't skew
+    the timings.
+    """
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
@@ -0,0 +1,140 @@
+"""Offline import of CourtListener bulk data.
+
+CourtListener publishes its dockets, opinion clusters and opinions as
+one tarball per type and court, of one JSON file per object shaped like
+the REST API's. The tarballs are read as streams, without extracting
+them: the dockets and clusters of the court are collected first, as
+they are small, and then each opinion is turned into a CaseFiling as
+soon as it is read, and goes through the same parse and write path as
+the sync.
+"""
+
+import json
+import tarfile
+
+import date
+import db
+from .http import DOCKET_LIST_FILTERS, OPINION_CLUSTER_FILTERS, url_id
+from .ingest import DEFAULT_BATCH_SIZE, BatchWriter
+from .models import CaseFiling, Justice
+import pipeline
+import utils
+
+
+DEFAULT_COURT = 'cal'
+
+
+def run(dockets_path, clusters_path, opinions_path, court=DEFAULT_COURT,
+        filed_since=date.DEFAULT_START_DATE, batch_size=DEFAULT_BATCH_SIZE,
+        processes=None):
+    """Imports the case filings of COURT filed on or after FILED_SINCE
+    from the bulk data tarballs at DOCKETS_PATH, CLUSTERS_PATH and
+    OPINIONS_PATH.
+
+    Afterwards, the sync watermark is advanced to the latest
+    `date_modified` imported (but not past case filings that failed to
+    be imported), so that the next sync only fetches what has changed
+    since the bulk data was exported.
+    """
+    db_connection = db.connection()
+    Justice.load(db_connection)
+    watermark = db.get_sync_state(db_connection, db.SYNC_WATERMARK)
+    stored_sha1s = CaseFiling.all_stored_sha1s(db_connection)
+    case_filings = read_case_filings(dockets_path, clusters_path,
+                                     opinions_path, court, filed_since,
+                                     stored_sha1s)
+    with BatchWriter(db_connection, batch_size) as writer:
+        for case_filing in pipeline.run(case_filings, processes):
+            writer.add(case_filing)
+    if writer.failed:
+        utils.warn('Unable to import {} case filings, to be synced again: {}',
+                   len(writer.failed), ', '.join(writer.failed))
+    latest_modified = writer.watermark(watermark)
+    if latest_modified != watermark:
+        db.set_sync_state(db_connection, db.SYNC_WATERMARK, latest_modified)
+    db.report_text_storage(db_connection)
+
+
+def read_case_filings(dockets_path, clusters_path, opinions_path,
+                      court=DEFAULT_COURT, filed_since=None,
+                      stored_sha1s=None):
+    """Yields an unparsed CaseFiling for each opinion in the tarball at
+    OPINIONS_PATH whose cluster (from CLUSTERS_PATH) was filed on or
+    after FILED_SINCE, if given, and whose docket (from DOCKETS_PATH)
+    is in COURT. STORED_SHA1S is as for sync.get_active_docket().
+    """
+    stored_sha1s = stored_sha1s or {}
+
+    utils.log('Reading dockets from "{}"', dockets_path)
+    # Docket ID => docket entry
+    dockets = {}
+    for docket in read_objects(dockets_path):
+        if url_id(docket.get('court')) != court:
+            continue
+        clusters = docket.get('clusters') or []
+        if len(clusters) != 1:
+            utils.warn('Skipping docket {} with {} opinion clusters',
+                       docket.get('docket_number'), len(clusters))
+            continue
+        dockets[str(docket['id'])] = _only_fields(docket,
+                                                  DOCKET_LIST_FILTERS)
+    utils.log('Read {} dockets of court {}', len(dockets), court)
+
+    utils.log('Reading opinion clusters from "{}"', clusters_path)
+    # Cluster ID => (docket entry, opinion cluster)
+    clusters = {}
+    for cluster in read_objects(clusters_path):
+        docket = dockets.get(url_id(cluster.get('docket')))
+        if docket is None:
+            continue
+        if filed_since and cluster.get('date_filed') < filed_since:
+            continue
+        if len(cluster.get('sub_opinions') or []) != 1:
+            utils.warn('Skipping docket {} with {} opinions',
+                       docket.get('docket_number'),
+                       len(cluster.get('sub_opinions') or []))
+            continue
+        clusters[str(cluster['id'])] = (
+            docket, _only_fields(cluster, OPINION_CLUSTER_FILTERS)
+        )
+    # Only the clusters are needed from here on.
+    dockets = None
+    utils.log('Read {} opinion clusters', len(clusters))
+
+    utils.log('Reading opinions from "{}"', opinions_path)
+    for opinion in read_objects(opinions_path):
+        docket_and_cluster = clusters.pop(url_id(opinion.get('cluster')), None)
+        if docket_and_cluster is None:
+            continue
+        docket, cluster = docket_and_cluster
+        stored_sha1 = stored_sha1s.get(docket.get('docket_number'))
+        yield CaseFiling(docket, stored_sha1=stored_sha1, parse=False,
+                         opinion_cluster=cluster, opinion=opinion)
+    if clusters:
+        utils.warn('{} opinion clusters have no opinion in "{}"',
+                   len(clusters), opinions_path)
+
+
+def read_objects(tarball_path):
+    """Yields the object in each JSON file of the (optionally
+    compressed) tarball at TARBALL_PATH, reading it as a stream.
+    """
+    with tarfile.open(tarball_path, 'r|*') as tarball:
+        for member in tarball:
+            if not member.isfile() or not member.name.endswith('.json'):
+                continue
+            json_file = tarball.extractfile(member)
+            try:
+                yield json.load(json_file)
+            except ValueError as e:
+                utils.warn('Skipping {} in "{}": {}', member.name,
+                           tarball_path, e)
+            finally:
+                json_file.close()
+
+
+def _only_fields(obj, filter_dict):
+    """Returns the fields of OBJ that the API would return with the
+    field selection of FILTER_DICT, so that the rest of it is freed.
+    """
+    return {field: obj.get(field) for field in filter_dict['fields']}
@@ -0,0 +1,177 @@
+"""HTTP response cache for CacheControl, stored in a single SQLite file.
+
+Cached responses are zlib-compressed. Once the compressed entries take
+up more than the cache's maximum size, entries that have expired are
+evicted first, followed by the least recently used ones. Each entry
+expires as its response does: per the Expires header that CacheHeuristic
+sets, i.e. at the posting date after the response was served.
+
+Hits don't write to the database: their access times are kept in memory
+and written in one go before evicting, and on close().
+"""
+
+from email.utils import mktime_tz, parsedate, parsedate_tz
+import os
+from time import time
+import threading
+import zlib
+
+import apsw
+from cachecontrol.cache import BaseCache
+import msgpack
+
+import date
+import utils
+
+
+# Can be overridden by the HTTP_CACHE_FILE environment variable.
+DEFAULT_CACHE_PATH = os.environ.get('HTTP_CACHE_FILE') \
+                     or utils.project_path('.cache.db')
+# In bytes of compressed responses.
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+# Eviction stops once the cache is down to this fraction of its maximum
+# size, so that it isn't triggered again by the very next response.
+_EVICT_TO = 0.9
+
+_INIT_SQL = """
+    CREATE TABLE IF NOT EXISTS responses (
+        key         TEXT        PRIMARY KEY,
+        body        BLOB        NOT NULL,
+        -- Size of the uncompressed response.
+        size        INTEGER     NOT NULL,
+        expires_at  REAL        NOT NULL,
+        accessed_at REAL        NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS IDX_Responses_AccessedAt
+        ON responses (accessed_at);
+"""
+
+
+class SQLiteCache(BaseCache):
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.evicted = 0
+        # The connection is shared by every thread of the HTTP session,
+        # so only one of them may use it at a time.
+        self._lock = threading.Lock()
+        # Key => access time not written yet
+        self._accessed = {}
+        self._connection = apsw.Connection(path)
+        cur = self._connection.cursor()
+        cur.execute(_INIT_SQL)
+        cur.execute('SELECT TOTAL(LENGTH(body)) FROM responses;')
+        (self._stored_size,) = cur.fetchone()
+
+    def get(self, key):
+        sql = 'SELECT body FROM responses WHERE key = ?;'
+        with self._lock:
+            cur = self._connection.cursor()
+            cur.execute(sql, (key,))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            self._accessed[key] = time()
+        return zlib.decompress(row[0])
+
+    def set(self, key, value):
+        sql = """
+            INSERT OR REPLACE INTO responses (
+                key,
+                body,
+                size,
+                expires_at,
+                accessed_at
+            )
+            VALUES (?, ?, ?, ?, ?);
+        """
+        body = zlib.compress(value)
+        expires_at = _expires_at(value)
+        with self._lock, self._connection:
+            self._accessed.pop(key, None)
+            self._delete(key)
+            self._connection.cursor().execute(sql, (
+                key,
+                buffer(body),
+                len(value),
+                expires_at,
+                time()
+            ))
+            self._stored_size += len(body)
+            if self._stored_size > self.max_size:
+                self._evict()
+
+    def delete(self, key):
+        with self._lock, self._connection:
+            self._delete(key)
+
+    def close(self):
+        with self._lock:
+            # Also called by CacheControl, once the connection is closed.
+            if self._accessed:
+                with self._connection:
+                    self._write_access_times()
+            self._connection.close()
+
+    def report(self):
+        utils.log('HTTP cache: {:.1f} MB stored, {} responses evicted',
+                  self._stored_size / 1e6, self.evicted)
+
+    def _delete(self, key):
+        cur = self._connection.cursor()
+        cur.execute('SELECT LENGTH(body) FROM responses WHERE key = ?;', (key,))
+        row = cur.fetchone()
+        if row is not None:
+            cur.execute('DELETE FROM responses WHERE key = ?;', (key,))
+            self._stored_size -= row[0]
+
+    def _evict(self):
+        """Deletes expired, then least recently used, responses until
+        the cache is down to _EVICT_TO of its maximum size.
+        """
+        target_size = self.max_size * _EVICT_TO
+        self._write_access_times()
+        cur = self._connection.cursor()
+        cur.execute("""
+            SELECT key, LENGTH(body) FROM responses
+            ORDER BY expires_at > ?, accessed_at;
+        """, (time(),))
+        evicted = []
+        for key, size in cur:
+            if self._stored_size <= target_size:
+                break
+            evicted.append((key,))
+            self._stored_size -= size
+        cur.executemany('DELETE FROM responses WHERE key = ?;', evicted)
+        self.evicted += len(evicted)
+
+    def _write_access_times(self):
+        self._connection.cursor().executemany(
+            'UPDATE responses SET accessed_at = ? WHERE key = ?;',
+            [(accessed_at, key)
+             for key, accessed_at in self._accessed.iteritems()]
+        )
+        self._accessed.clear()
+
+
+def _expires_at(value):
+    """Returns when the response cached as VALUE (as serialized by
+    CacheControl) expires, as a timestamp: per its Expires header, or
+    else per its Date header as CacheHeuristic would. Responses with
+    neither, or that can't be read, expire right away.
+    """
+    try:
+        version, data = value.split(',', 1)
+        if version != 'cc=4':
+            return time()
+        headers = msgpack.loads(data, raw=False)['response']['headers']
+    except (ValueError, KeyError, TypeError):
+        return time()
+    headers = {name.lower(): header for name, header in headers.iteritems()}
+    expires = parsedate_tz(headers.get('expires', ''))
+    if expires is not None:
+        return mktime_tz(expires)
+    response_date = parsedate(headers.get('date', ''))
+    if response_date is not None:
+        return date.response_expiry(response_date)
+    return time()
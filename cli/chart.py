@@ -1,120 +1,94 @@
+from bisect import bisect_left, bisect_right
+import codecs
+from collections import OrderedDict
 from datetime import datetime
-
-import yattag
+from itertools import groupby
+from operator import itemgetter
+import os.path
+from StringIO import StringIO
 
 import db
+import export
+import metrics
 from .models import Justice, OpinionType
 import utils
 
 
-_CSS_PATH = utils.project_path('chart.css')
+# Extensions of the export.WRITERS used unless others are given.
+DEFAULT_FORMATS = ('html',)
+# Where charts are written.
+OUT_PATH = utils.project_path('out')
 
 
-def build():
-    def concurring_justices(opinion_id):
-        """Returns a set of concurring justice IDs for the given OPINION_ID."""
-        sql = 'SELECT justice FROM concurrences WHERE opinion_id = ?'
-        cur = db_connection.cursor()
-        cur.execute(sql, (opinion_id,))
-        return {row[0] for row in cur}
+# Opinions and their concurring justices, one row per concurrence,
+# ordered by docket. {} is the condition on the opinions to select.
+_OPINIONS_SQL = """
+    SELECT
+        o.docket_number,
+        o.id,
+        o.type_id,
+        o.effective_type_id,
+        o.authoring_justice,
+        c.justice
+    FROM opinions o
+    LEFT JOIN concurrences c ON c.opinion_id = o.id
+    WHERE {}
+    ORDER BY o.docket_number, o.id;
+"""
+# Dockets that are left out of the chart.
+_EXCLUDED_DOCKETS_SQL = """
+    SELECT *
+    FROM docket_numbers_end_in_letter
 
-    def ignored_case_filings_warning():
-        """Remove this function and it's usage below once this has been
-        given a solution.
-        """
-        sql = 'SELECT COUNT(*) FROM docket_numbers_end_in_letter'
-        cur = db_connection.cursor()
-        cur.execute(sql)
-        utils.warn(
-            '{} Case Filings whose docket numbers end in a letter are being ignored',
-            cur.fetchone()[0]
-        )
+    UNION
 
-    majority_opinions_sql = """
-        SELECT
-            docket_number,
-            id,
-            authoring_justice
-        FROM majority_opinions
-        WHERE docket_number NOT IN (
-            SELECT *
-            FROM docket_numbers_end_in_letter
-            
-            UNION
-            
-            SELECT docket_number
-            FROM case_filings
-            WHERE exclude_from_chart = 1
-        );
-    """
-    secondary_opinions_sql = """
-        SELECT
-            id,
-            type_id,
-            effective_type_id,
-            authoring_justice
-        FROM secondary_opinions
-        WHERE docket_number = ?
-        ORDER BY type_id, effective_type_id, authoring_justice;
+    SELECT docket_number
+    FROM case_filings
+    WHERE exclude_from_chart = 1
+"""
+
+
+def build(start_date=None, end_date=None, formats=DEFAULT_FORMATS):
+    """Builds the agreement chart of the case filings filed from
+    START_DATE to END_DATE, inclusive, in each of FORMATS (extensions of
+    export.WRITERS). Either date may be None to leave the window open on
+    that side.
     """
+    build_windows([(start_date, end_date)], formats)
 
-    all_justices = Justice.all()
-    # We keep a list of two ints for each pair of justices representing,
-    # respectively, the number of times they concur and the total number
-    # of times they concur or dissent.
-    count_chart = {}
-    for i, j1 in enumerate(all_justices):
-        for j2 in all_justices[i+1:]:
-            key = frozenset([j1.shorthand, j2.shorthand])
-            count_chart[key] = [0, 0]
 
-    db_connection = db.connect()
-    try:
+def build_windows(windows, formats=DEFAULT_FORMATS):
+    """Builds an agreement chart for each (start date, end date) in
+    WINDOWS (see build()). The agreement counts are only read once, so
+    each additional window costs little more than writing its chart.
+    """
+    with metrics.span('chart_build'):
+        db_connection = db.connection()
+        Justice.load(db_connection)
+        all_justices = Justice.all()
         # TODO: Remove this call when a solution is found.
-        ignored_case_filings_warning()
-
-        majority_cur = db_connection.cursor()
-        majority_cur.execute(majority_opinions_sql)
-        for docket_num, majority_id, majority_author in majority_cur:
-            concurs = {j.shorthand: set() for j in all_justices}
-            dissents = {j.shorthand: set() for j in all_justices}
-
-            concurs[majority_author] |= concurring_justices(majority_id)
-
-            secondary_cur = db_connection.cursor()
-            secondary_cur.execute(secondary_opinions_sql, (docket_num,))
-            for secondary_id, type_id, effective_type_id, secondary_author in secondary_cur:
-                if type_id == OpinionType.CONCURRING_AND_DISSENTING:
-                    if effective_type_id is None:
-                        msg = "Effective type for CONCURRING AND DISSENTING" \
-                              " Opinion ID#{} is not set"
-                        utils.warn(msg, secondary_id)
-                        continue
-                else:
-                    effective_type_id = type_id
-
-                justices = concurring_justices(secondary_id)
-                concurs[secondary_author] |= justices
-                if effective_type_id == OpinionType.CONCURRING:
-                    concurs[majority_author] |= justices | {secondary_author}
-                elif effective_type_id == OpinionType.DISSENTING:
-                    dissents[majority_author] |= justices | {secondary_author}
-                else:
-                    assert False
-
-            for j1 in [j.shorthand for j in all_justices]:
-                # Justices can't concur with/dissent from themselves,
-                # so we don't include them if they're in the sets.
-                for j2 in concurs[j1] - {j1}:
-                    key = frozenset([j1, j2])
-                    count_chart[key][0] += 1
-                    count_chart[key][1] += 1
-                for j2 in dissents[j1] - {j1}:
-                    key = frozenset([j1, j2])
-                    count_chart[key][1] += 1
-    finally:
-        db_connection.close()
+        _ignored_case_filings_warning(db_connection)
+        with metrics.span('chart_count'):
+            refresh_agreement_counts(db_connection, all_justices)
+            cumulative_counts = CumulativeCounts(db_connection, all_justices)
+
+        render_cache = export.RenderCache(
+            os.path.join(OUT_PATH, '.render_cache.json')
+        )
+        try:
+            for start_date, end_date in windows:
+                count_chart = cumulative_counts.window(start_date, end_date)
+                _export(count_chart, all_justices, start_date, end_date,
+                        formats, render_cache)
+        finally:
+            render_cache.save()
+
 
+def _export(count_chart, justices, start_date, end_date, formats,
+            render_cache):
+    """Writes the rate chart of COUNT_CHART in each of FORMATS, unless
+    RENDER_CACHE has it written already.
+    """
     rate_chart = {}
     for key, counts in count_chart.iteritems():
         try:
@@ -122,57 +96,349 @@ def build():
         except ZeroDivisionError:
             rate_chart[key] = -1
 
+    window_str = ''
+    if start_date or end_date:
+        window_str = '{}_to_{}_'.format(start_date or 'start', end_date or 'end')
     date_str = datetime.now().strftime('%Y-%d-%m_%H:%M:%S')
-    filepath = utils.project_path('out', 'agreement_chart_{}.html'.format(date_str))
-    with open(filepath, 'w+') as f:
-        f.write(generate(rate_chart, all_justices))
+    for extension in formats:
+        writer = export.WRITERS[extension]()
+        name = 'agreement_chart_{}.{}'.format(window_str[:-1] or 'all',
+                                              extension)
+        chart_hash = writer.hash(rate_chart, justices)
+        filepath = render_cache.is_current(name, chart_hash)
+        if filepath:
+            utils.log('Unchanged "{}"', filepath)
+            continue
+        filename = 'agreement_chart_{}{}.{}'.format(window_str, date_str,
+                                                    extension)
+        filepath = os.path.join(OUT_PATH, filename)
+        with metrics.span('chart_generate'), \
+                codecs.open(filepath, 'w', 'utf8') as f:
+            writer.write(f, rate_chart, justices)
+        metrics.increment('charts_written')
         print('Exported "{}"'.format(filepath))
+        render_cache.set(name, chart_hash, filepath)
+
+
+class CumulativeCounts(object):
+    """Running totals of the materialized agreement counts by filing
+    date, so that the counts for any window of filing dates are the
+    difference between two of the totals.
+    """
+
+    def __init__(self, db_connection, justices):
+        sql = """
+            SELECT
+                cf.filed_on,
+                a.justice_1,
+                a.justice_2,
+                SUM(a.concur_count),
+                SUM(a.total_count)
+            FROM agreement_counts a
+            JOIN case_filings cf ON cf.docket_number = a.docket_number
+            WHERE a.docket_number NOT IN ({})
+            GROUP BY cf.filed_on, a.justice_1, a.justice_2
+            ORDER BY cf.filed_on;
+        """.format(_EXCLUDED_DOCKETS_SQL)
+        self._keys = _empty_count_chart(justices).keys()
+        key_indices = {key: i for i, key in enumerate(self._keys)}
+        # Sorted filing dates, and the totals, as a list of concur
+        # counts followed by a list of total counts (both ordered like
+        # _keys), up to and including each date.
+        self._dates = []
+        self._totals = []
+        running_totals = [0] * (2 * len(self._keys))
+        cur = db_connection.cursor()
+        cur.execute(sql)
+        for filed_on, rows in groupby(cur, key=itemgetter(0)):
+            for _, j1, j2, concur_count, total_count in rows:
+                i = key_indices[frozenset([j1, j2])]
+                running_totals[i] += concur_count
+                running_totals[len(self._keys) + i] += total_count
+            self._dates.append(filed_on)
+            self._totals.append(list(running_totals))
+
+    def window(self, start_date=None, end_date=None):
+        """Returns the count chart (see count_agreements()) of the case
+        filings filed from START_DATE to END_DATE, inclusive.
+        """
+        if start_date and end_date and start_date > end_date:
+            raise ValueError('Window {} to {} ends before it starts'
+                             .format(start_date, end_date))
+        end = self._totals_before(bisect_right, end_date)
+        start = self._totals_before(bisect_left, start_date)
+        n = len(self._keys)
+        return {
+            key: [end[i] - start[i], end[n + i] - start[n + i]]
+            for i, key in enumerate(self._keys)
+        }
+
+    def _totals_before(self, bisect, date_str):
+        """Returns the totals of every date before the index given by
+        BISECT for DATE_STR in the sorted dates.
+        """
+        if date_str is None:
+            i = 0 if bisect is bisect_left else len(self._dates)
+        else:
+            i = bisect(self._dates, date_str)
+        if i == 0:
+            return [0] * (2 * len(self._keys))
+        return self._totals[i - 1]
+
+
+def verify():
+    """Checks the materialized agreement counts against a full recount
+    and warns about every pair of justices whose counts differ. Returns
+    True if they all match.
+    """
+    db_connection = db.connection()
+    Justice.load(db_connection)
+    all_justices = Justice.all()
+    refresh_agreement_counts(db_connection, all_justices)
+    materialized = read_agreement_counts(db_connection, all_justices)
+    recounted = count_agreements(db_connection, all_justices)
+
+    mismatches = 0
+    for key, counts in sorted(recounted.iteritems()):
+        if materialized[key] != counts:
+            mismatches += 1
+            utils.warn('Agreement counts for {} are {}, but should be {}',
+                       '/'.join(sorted(key)), materialized[key], counts)
+    utils.log('{} mismatched agreement counts', mismatches)
+    return not mismatches
+
+
+def count_agreements(db_connection, justices):
+    """Returns a dict of frozenset([shorthand, shorthand]) => [number of
+    times the pair concurs, number of times the pair concurs or
+    dissents] for every pair of JUSTICES, recounted from every opinion.
+
+    All opinions and their concurrences are read with a single query,
+    ordered by docket, and each docket is counted as soon as all of its
+    opinions have been read.
+    """
+    n = len(Justice.all())
+    # Indexed by _pair_index().
+    concur_counts = [0] * (n * n)
+    total_counts = [0] * (n * n)
+    cur = db_connection.cursor()
+    cur.execute(_OPINIONS_SQL.format(
+        'o.docket_number NOT IN ({})'.format(_EXCLUDED_DOCKETS_SQL)
+    ))
+    for _, i1, i2, concurred in _all_agreements(cur, justices):
+        pair = _pair_index(i1, i2, n)
+        if concurred:
+            concur_counts[pair] += 1
+        total_counts[pair] += 1
+
+    count_chart = _empty_count_chart(justices)
+    for j1 in justices:
+        for j2 in justices:
+            if j1.index < j2.index:
+                pair = _pair_index(j1.index, j2.index, n)
+                count_chart[frozenset([j1.shorthand, j2.shorthand])] = \
+                    [concur_counts[pair], total_counts[pair]]
+    return count_chart
+
+
+def read_agreement_counts(db_connection, justices):
+    """Like count_agreements(), but sums the materialized agreement
+    counts instead. They should be refreshed first (see
+    refresh_agreement_counts()).
+    """
+    sql = """
+        SELECT
+            justice_1,
+            justice_2,
+            SUM(concur_count),
+            SUM(total_count)
+        FROM agreement_counts
+        WHERE docket_number NOT IN ({})
+        GROUP BY justice_1, justice_2;
+    """.format(_EXCLUDED_DOCKETS_SQL)
+    count_chart = _empty_count_chart(justices)
+    cur = db_connection.cursor()
+    cur.execute(sql)
+    for j1, j2, concur_count, total_count in cur:
+        count_chart[frozenset([j1, j2])] = [concur_count, total_count]
+    return count_chart
+
+
+def refresh_agreement_counts(db_connection, justices):
+    """Recounts the materialized agreement counts of every docket whose
+    opinions or concurrences have changed since they were last counted.
+    Returns the number of dockets recounted.
+    """
+    select_stale_sql = 'SELECT docket_number FROM stale_agreement_counts;'
+    delete_sql = 'DELETE FROM agreement_counts WHERE docket_number = ?;'
+    insert_sql = """
+        INSERT INTO agreement_counts (
+            docket_number,
+            justice_1,
+            justice_2,
+            concur_count,
+            total_count
+        )
+        VALUES (?, ?, ?, ?, ?);
+    """
+    all_justices = Justice.all()
+    with db_connection:
+        cur = db_connection.cursor()
+        stale_dockets = [(row[0],) for row in cur.execute(select_stale_sql)]
+        if not stale_dockets:
+            return 0
+        utils.log('Recounting agreements for {} dockets', len(stale_dockets))
+        cur.executemany(delete_sql, stale_dockets)
+
+        # Docket number, justice index, other justice index => [concur
+        # count, total count]
+        docket_counts = {}
+        cur.execute(_OPINIONS_SQL.format(
+            'o.docket_number IN (SELECT docket_number FROM stale_agreement_counts)'
+        ))
+        for docket_number, i1, i2, concurred in _all_agreements(cur, justices):
+            key = (docket_number, min(i1, i2), max(i1, i2))
+            counts = docket_counts.setdefault(key, [0, 0])
+            if concurred:
+                counts[0] += 1
+            counts[1] += 1
+
+        rows = []
+        for (docket_number, i1, i2), counts in docket_counts.iteritems():
+            # Stored in order of shorthand, like the rows of migration 002.
+            pair = sorted([all_justices[i1].shorthand,
+                           all_justices[i2].shorthand])
+            rows.append((docket_number,) + tuple(pair) + tuple(counts))
+        cur.executemany(insert_sql, rows)
+        cur.execute('DELETE FROM stale_agreement_counts;')
+    return len(stale_dockets)
+
+
+def _empty_count_chart(justices):
+    count_chart = {}
+    for i, j1 in enumerate(justices):
+        for j2 in justices[i+1:]:
+            count_chart[frozenset([j1.shorthand, j2.shorthand])] = [0, 0]
+    return count_chart
+
+
+def _pair_index(i1, i2, n):
+    """Returns the index of the pair of justices with indices I1 and I2,
+    in either order, in a list of N * N counts.
+    """
+    return min(i1, i2) * n + max(i1, i2)
+
+
+def _bit_indices(mask):
+    """Yields the index of every bit set in MASK, from the lowest."""
+    while mask:
+        lowest_bit = mask & -mask
+        yield lowest_bit.bit_length() - 1
+        mask ^= lowest_bit
+
+
+def _all_agreements(cursor, justices):
+    """Yields (docket number, justice index, other justice index,
+    concurred) for every agreement (see _docket_agreements()) among the
+    opinions selected by _OPINIONS_SQL through CURSOR. Justices are
+    indexed as in Justice.all(), and must be among JUSTICES.
+    """
+    indices = {j.shorthand: j.index for j in justices}
+    for docket_number, rows in groupby(cursor, key=itemgetter(0)):
+        # Opinion ID => [type ID, effective type ID, authoring justice
+        # index, bitmask of concurring justices]
+        opinions = OrderedDict()
+        for _, opinion_id, type_id, effective_type_id, author, justice in rows:
+            if opinion_id not in opinions:
+                opinions[opinion_id] = [type_id, effective_type_id,
+                                        indices[author], 0]
+            if justice is not None:
+                opinions[opinion_id][3] |= 1 << indices[justice]
+
+        majority_opinions = []
+        secondary_opinions = []
+        for opinion_id, opinion in opinions.iteritems():
+            if opinion[0] == OpinionType.MAJORITY:
+                majority_opinions.append(opinion)
+            else:
+                secondary_opinions.append([opinion_id] + opinion)
+        secondary_opinions.sort(key=itemgetter(1, 2, 3))
+
+        for majority_opinion in majority_opinions:
+            concurs, dissents = _docket_agreements(majority_opinion,
+                                                   secondary_opinions)
+            for i1, mask in concurs.iteritems():
+                # Justices can't concur with/dissent from themselves,
+                # so we don't include them if they're in the masks.
+                for i2 in _bit_indices(mask & ~(1 << i1)):
+                    yield docket_number, i1, i2, True
+            for i1, mask in dissents.iteritems():
+                for i2 in _bit_indices(mask & ~(1 << i1)):
+                    yield docket_number, i1, i2, False
+
+
+def _docket_agreements(majority_opinion, secondary_opinions):
+    """Returns (concurs, dissents), dicts of justice index => bitmask of
+    the justices that concur with or dissent from that justice in a
+    docket, given its MAJORITY_OPINION as a [type ID, effective type ID,
+    authoring justice index, bitmask of concurring justices] list and
+    its SECONDARY_OPINIONS as the same lists prefixed by their opinion
+    IDs.
+    """
+    majority_author, majority_justices = majority_opinion[2:]
+    concurs = {majority_author: majority_justices}
+    dissents = {}
+
+    for secondary_id, type_id, effective_type_id, secondary_author, justices \
+            in secondary_opinions:
+        if type_id == OpinionType.CONCURRING_AND_DISSENTING:
+            if effective_type_id is None:
+                msg = "Effective type for CONCURRING AND DISSENTING" \
+                      " Opinion ID#{} is not set"
+                utils.warn(msg, secondary_id)
+                continue
+        else:
+            effective_type_id = type_id
+
+        concurs[secondary_author] = concurs.get(secondary_author, 0) | justices
+        justices |= 1 << secondary_author
+        if effective_type_id == OpinionType.CONCURRING:
+            concurs[majority_author] |= justices
+        elif effective_type_id == OpinionType.DISSENTING:
+            dissents[majority_author] = \
+                dissents.get(majority_author, 0) | justices
+        else:
+            assert False
+
+    return concurs, dissents
+
+
+def _ignored_case_filings_warning(db_connection):
+    """Remove this function and it's usage below once this has been
+    given a solution.
+    """
+    sql = 'SELECT COUNT(*) FROM docket_numbers_end_in_letter'
+    cur = db_connection.cursor()
+    cur.execute(sql)
+    utils.warn(
+        '{} Case Filings whose docket numbers end in a letter are being ignored',
+        cur.fetchone()[0]
+    )
 
 
 def generate(chart, justices, indent=False):
-    doc, tag, text, line = yattag.Doc().ttl()
-
-    with tag('style'), open(_CSS_PATH) as css:
-        doc.asis(css.read())
-
-    with tag('table', id='agreeTable'):
-        # Top labels
-        with tag('tr'):
-            line('th', '')
-            for j in justices[1:]:
-                line('th', j.shorthand)
-        # Left labels and chart body
-        for col, j_left in enumerate(justices):
-            with tag('tr'):
-                # Left space
-                if col > 0:
-                    line('th', '', colspan=col)
-                # Left label
-                line('th', j_left.shorthand)
-                # Chart body
-                for j_top in justices[col+1:]:
-                    key = frozenset([j_left.shorthand, j_top.shorthand])
-                    rate = int(round(chart[key]))
-                    with tag('td'):
-                        if rate == -1:
-                            doc.attr(klass='error')
-                            text('&#9473;')
-                        else:
-                            if rate > 90:
-                                doc.attr(klass='high')
-                            elif rate < 10:
-                                doc.attr(klass='low')
-                            text('{}%'.format(rate))
-
-    with tag('table', id='legendTable'):
-        for j in justices:
-            with tag('tr'):
-                line('td', j.shorthand)
-                line('td', j.fullname)
-
-    return doc.getvalue() if not indent else yattag.indent(doc.getvalue(),
-                                                           indentation='  ',
-                                                           newline='\n')
+    """Returns the HTML agreement chart of the rate CHART of JUSTICES as
+    a string. See export.HtmlWriter to write it to a file instead.
+    """
+    buf = StringIO()
+    with metrics.span('chart_generate'):
+        export.HtmlWriter().write(buf, chart, justices)
+    if not indent:
+        return buf.getvalue()
+    # Imported here so that importing this module doesn't load yattag.
+    import yattag
+
+    return yattag.indent(buf.getvalue(), indentation='  ', newline='\n')
 
 
 def print_chart(chart, justices):
@@ -0,0 +1,182 @@
+"""Synthetic corpus of case filings for benchmarks.
+
+Each case filing has a docket entry, an opinion cluster and an opinion
+shaped like those of the CourtListener API, and a plain text of a few
+pages of filler ending in the summary of its opinions that regex.py
+parses, naming the justices in config/justices.csv. The corpus is
+generated from a seed, so the same seed always gives the same corpus.
+"""
+
+from datetime import datetime, timedelta
+import hashlib
+import random
+
+import date
+from .models import JUSTICES_CSV_PATH
+
+
+_WORDS = (
+    'appellant', 'respondent', 'petitioner', 'court', 'trial', 'appeal',
+    'judgment', 'statute', 'evidence', 'jury', 'instruction', 'claim',
+    'record', 'finding', 'review', 'standard', 'error', 'prejudice',
+    'defendant', 'plaintiff', 'contract', 'damages', 'section', 'code',
+    'constitutional', 'due', 'process', 'legislature', 'intent', 'rule',
+    'precedent', 'reasonable', 'substantial', 'abuse', 'discretion',
+    'motion', 'hearing', 'sentence', 'penalty', 'arbitration', 'remand',
+    'the', 'the', 'the', 'of', 'of', 'to', 'and', 'and', 'a', 'in', 'that',
+    'is', 'was', 'not', 'for', 'we', 'by', 'on', 'under', 'which', 'as',
+)
+_SECONDARY_TYPES = ('concurring', 'dissenting', 'concurring and dissenting')
+# The corpus' docket entries were modified within this many days before
+# the newest one.
+_MODIFIED_SPAN_DAYS = 365
+
+
+class Corpus(object):
+    def __init__(self, size, seed=0, justices_path=JUSTICES_CSV_PATH):
+        """Generates SIZE case filings from SEED, whose opinions are by
+        the justices in the CSV file at JUSTICES_PATH. The first
+        justice is taken to be the Chief Justice.
+        """
+        import unicodecsv as csv  # This helps fix unicode issues.
+
+        with open(justices_path, 'rb') as justices_csv:
+            self.justices = [row['short_name']
+                             for row in csv.DictReader(justices_csv)]
+        self.size = size
+        self.seed = seed
+        # Case filings as dicts, most recently modified first, as the
+        # API lists them.
+        self.case_filings = []
+        rng = random.Random(seed)
+        start_date = date.str_to_date(date.DEFAULT_START_DATE)
+        newest_modified = datetime(2020, 12, 31)
+        for i in range(size):
+            plain_text = self._plain_text(rng)
+            self.case_filings.append({
+                'id': i + 1,
+                'docket_number': 'S{:06d}{}'.format(
+                    200000 + i, 'A' if rng.random() < 0.03 else ''
+                ),
+                'date_filed': date.date_to_str(
+                    start_date + timedelta(days=rng.randrange(700))
+                ),
+                'date_modified': (
+                    newest_modified - timedelta(
+                        seconds=(i + rng.random()) * _MODIFIED_SPAN_DAYS
+                                * 86400 / size
+                    )
+                ).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                'sha1': hashlib.sha1(plain_text.encode('utf8')).hexdigest(),
+                'plain_text': plain_text,
+            })
+        self._by_id = {cf['id']: cf for cf in self.case_filings}
+
+    def get(self, id_):
+        """Returns the case filing whose docket entry, opinion cluster
+        and opinion all have the ID_, or None.
+        """
+        return self._by_id.get(id_)
+
+    def docket_entry(self, case_filing, base_url):
+        return {
+            'id': case_filing['id'],
+            'court': base_url + '/api/rest/v3/courts/cal/',
+            'docket_number': case_filing['docket_number'],
+            'date_modified': case_filing['date_modified'],
+            'clusters': [
+                '{}/api/rest/v3/clusters/{}/'.format(base_url, case_filing['id'])
+            ],
+        }
+
+    def opinion_cluster(self, case_filing, base_url):
+        return {
+            'id': case_filing['id'],
+            'absolute_url': '/opinion/{}/synthetic/'.format(case_filing['id']),
+            'panel': [],
+            'non_participating_judges': [],
+            'sub_opinions': [
+                '{}/api/rest/v3/opinions/{}/'.format(base_url, case_filing['id'])
+            ],
+            'judges': '',
+            'date_filed': case_filing['date_filed'],
+            'date_filed_is_approximate': False,
+        }
+
+    def opinion(self, case_filing):
+        return {
+            'id': case_filing['id'],
+            'author': None,
+            'joined_by': [],
+            'author_str': '',
+            'type': '010combined',
+            'sha1': case_filing['sha1'],
+            'download_url': None,
+            'plain_text': case_filing['plain_text'],
+        }
+
+    def _plain_text(self, rng):
+        paragraphs = [u'Filed {}/{}/19\nIN THE SUPREME COURT OF CALIFORNIA'
+                      .format(rng.randint(1, 12), rng.randint(1, 28))]
+        for _ in range(rng.randint(10, 40)):
+            sentences = []
+            for _ in range(rng.randint(3, 8)):
+                words = [rng.choice(_WORDS) for _ in range(rng.randint(8, 25))]
+                sentences.append(u' '.join(words).capitalize() + u'.')
+            # Lines are wrapped, as in the opinions' plain texts.
+            paragraph = u' '.join(sentences)
+            lines = [paragraph[i:i + 70] for i in range(0, len(paragraph), 70)]
+            paragraphs.append(u'\n'.join(lines))
+        paragraphs.append(self._opinions_summary(rng))
+        return u'\n\n'.join(paragraphs)
+
+    def _opinions_summary(self, rng):
+        """Returns the sentences naming the authors of a case filing's
+        opinions and the justices concurring in each.
+        """
+        chief = self.justices[0]
+        author = rng.choice(self.justices)
+        others = [j for j in self.justices if j != author]
+        concurring = rng.sample(others, rng.randint(2, len(others)))
+        sentences = [u'{} authored the opinion of the court{}.'.format(
+            self._title(author), self._concurring(concurring, chief)
+        )]
+        for _ in range(rng.choice((0, 0, 0, 1, 1, 2))):
+            secondary_author = rng.choice(others)
+            # regex.py doesn't match a Chief Justice concurring alone,
+            # so only associate justices join secondary opinions.
+            joining = rng.sample([j for j in others
+                                  if j not in (secondary_author, chief)],
+                                 rng.choice((0, 0, 1, 2)))
+            sentences.append(u'{} filed a {} opinion{}.'.format(
+                self._title(secondary_author),
+                rng.choice(_SECONDARY_TYPES),
+                self._concurring(joining, chief)
+            ))
+        return u'\n'.join(sentences)
+
+    def _title(self, justice):
+        if justice == self.justices[0]:
+            return u'Chief Justice ' + justice
+        return u'Justice ' + justice
+
+    def _concurring(self, justices, chief):
+        if not justices:
+            return u''
+        associates = [j for j in justices if j != chief]
+        names = []
+        if chief in justices:
+            names.append(u'Chief Justice {}'.format(chief))
+        if associates:
+            names.append(u'{} {}'.format(
+                u'Justices' if len(associates) > 1 else u'Justice',
+                _join_names(associates)
+            ))
+        return u', in which {} concurred'.format(u' and '.join(names))
+
+
+def _join_names(names):
+    """Returns NAMES as 'X', 'X and Y' or 'X, Y and Z'."""
+    if len(names) == 1:
+        return names[0]
+    return u'{} and {}'.format(u', '.join(names[:-1]), names[-1])
@@ -0,0 +1,120 @@
+"""Long-running sync that follows the posting schedule of opinions, run
+by `python -m cli daemon`.
+
+The daemon syncs once on startup, then sleeps until the next posting
+date (see date.next_posting_date()). From then on, it polls the active
+docket every POLL_INTERVAL seconds, bypassing the HTTP cache, until a
+poll finds new or changed case filings or POLL_WINDOW seconds have
+passed. Only the charts whose windows contain the filing dates of what
+was synced are rebuilt. The HTTP session and the database connection
+are kept from one cycle to the next.
+"""
+
+from datetime import datetime
+from time import sleep, time
+import traceback
+
+import chart
+import date
+import db
+from .http import DEFAULT_CONCURRENCY
+from .ingest import DEFAULT_BATCH_SIZE
+from .models import Justice
+from .session import close_http_session, start_http_session
+import sync
+import utils
+
+
+# Opinions are usually listed within minutes of the posting time, but
+# may take a few hours.
+DEFAULT_POLL_INTERVAL = 5 * 60
+DEFAULT_POLL_WINDOW = 3 * 60 * 60
+# Longest sleep, so that the daemon wakes up on time even if the clock
+# changes meanwhile.
+_MAX_SLEEP = 60 * 60
+
+
+def run(concurrency=DEFAULT_CONCURRENCY, batch_size=DEFAULT_BATCH_SIZE,
+        processes=None, formats=chart.DEFAULT_FORMATS, monthly=False,
+        poll_interval=DEFAULT_POLL_INTERVAL, poll_window=DEFAULT_POLL_WINDOW,
+        after_cycle=None):
+    """Syncs and charts until interrupted. CONCURRENCY, BATCH_SIZE and
+    PROCESSES are as for sync.run(), and FORMATS as for chart.build().
+    If MONTHLY, the monthly charts are rebuilt as well. AFTER_CYCLE, if
+    given, is called after each sync, e.g. to write metrics.
+    """
+    http_session = start_http_session()
+    try:
+        db_connection = db.connection()
+        Justice.load(db_connection)
+
+        def cycle():
+            """Syncs, rebuilds the affected charts and returns whether
+            anything was synced. A failed cycle is logged, and left for
+            the next one to retry.
+            """
+            try:
+                filed_on_dates = sync.sync_changes(
+                    http_session, db_connection, concurrency, batch_size,
+                    processes
+                )
+                if filed_on_dates:
+                    chart.build_windows(
+                        affected_windows(filed_on_dates, monthly), formats
+                    )
+                return bool(filed_on_dates)
+            except Exception:
+                utils.warn('Cycle failed:\n{}', traceback.format_exc())
+                return False
+            finally:
+                if after_cycle is not None:
+                    after_cycle()
+
+        cycle()
+        while True:
+            posting_date = date.next_posting_date(datetime.now())
+            utils.log('Sleeping until {}', posting_date)
+            _sleep_until(posting_date)
+            _poll(http_session, cycle, poll_interval, poll_window)
+    finally:
+        close_http_session(http_session)
+
+
+def affected_windows(filed_on_dates, monthly=False):
+    """Returns the chart windows (as for chart.build_windows()) that
+    contain any of FILED_ON_DATES: the whole chart and, if MONTHLY, the
+    month of each date.
+    """
+    windows = [(None, None)]
+    if monthly:
+        windows.extend(sorted({date.month_windows(filed_on, filed_on)[0]
+                               for filed_on in filed_on_dates if filed_on}))
+    return windows
+
+
+def _poll(http_session, cycle, poll_interval, poll_window):
+    """Runs CYCLE every POLL_INTERVAL seconds until it syncs something
+    or POLL_WINDOW seconds have passed, without using cached responses.
+    """
+    deadline = time() + poll_window
+    # Cached responses only expire at the next posting date, so they
+    # would hide what was posted meanwhile.
+    http_session.headers['Cache-Control'] = 'no-cache'
+    try:
+        while True:
+            if cycle():
+                return
+            if time() + poll_interval > deadline:
+                utils.log('Nothing new was posted')
+                return
+            sleep(poll_interval)
+    finally:
+        del http_session.headers['Cache-Control']
+
+
+def _sleep_until(dt):
+    while True:
+        seconds = (dt - datetime.now()).total_seconds()
+        if seconds <= 0:
+            return
+        sleep(min(seconds, _MAX_SLEEP))
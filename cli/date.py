@@ -17,6 +17,22 @@ def str_to_date(s, format=DATE_FORMAT):
     return datetime.strptime(s, format)
 
 
+def month_windows(start_date, end_date):
+    """Returns a list of (first day, last day) date strings for each
+    month from the month of START_DATE through the month of END_DATE,
+    where both are date strings.
+    """
+    windows = []
+    month = str_to_date(start_date).replace(day=1)
+    last_month = str_to_date(end_date).replace(day=1)
+    while month <= last_month:
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        windows.append((date_to_str(month),
+                        date_to_str(next_month - timedelta(days=1))))
+        month = next_month
+    return windows
+
+
 def local_to_utc(dt):
     t = localtime()
     seconds_delta = timegm(t) - timegm(gmtime(mktime(t)))
@@ -59,3 +75,12 @@ def next_posting_date(ref_date=datetime.now()):
         return next_monday_10am
     else:
         return next_thursday_10am
+
+
+def response_expiry(response_date):
+    """Returns when a response served at RESPONSE_DATE (a time tuple, as
+    from email.utils.parsedate()) expires, as a UTC timestamp: at the
+    next posting date after it.
+    """
+    expires_local = next_posting_date(datetime(*response_date[:6]))
+    return timegm(local_to_utc(expires_local).timetuple())
@@ -1,10 +1,49 @@
 import apsw
+import os
 import os.path
+import threading
+import zlib
 
 import utils
 
 
-_DB_PATH = utils.project_path('..', '.db')
+# Can be overridden by the DB_FILE environment variable or set_path().
+_DB_PATH = os.environ.get('DB_FILE') or utils.project_path('..', '.db')
+_MIGRATIONS_PATH = utils.project_path('migrations')
+# The migration that moves opinion texts to `opinion_texts`, after which
+# the database is vacuumed to give back the space they took up.
+_OPINION_TEXTS_MIGRATION = 3
+
+# Applied to every connection. In WAL mode, readers such as the admin
+# interface and chart builds don't block, and aren't blocked by, a sync.
+_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    # Only fsyncs at checkpoints, which is still safe in WAL mode.
+    ('synchronous', 'NORMAL'),
+    # Negative sizes are in KiB.
+    ('cache_size', -64 * 1024),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+)
+# How long to wait on a lock held by another connection, in milliseconds.
+BUSY_TIMEOUT = 5000
+# Number of prepared statements each connection keeps for reuse.
+STATEMENT_CACHE_SIZE = 256
+
+# Name of the sync state holding the latest `date_modified` of the
+# docket entries that have been synced.
+SYNC_WATERMARK = 'docket_date_modified'
+
+# Holds each thread's connection; see connection().
+_local = threading.local()
+
+
+def set_path(path):
+    """Points every connection opened from now on at the database at
+    PATH.
+    """
+    global _DB_PATH
+    _DB_PATH = path
 
 
 def exists():
@@ -23,10 +62,159 @@ def init():
         db_connection.close()
 
 
+def migrate():
+    """Applies the migrations in migrations/ that are newer than the
+    database. Migrations are named NNN_description.sql and applied in
+    order of NNN, which is then stored as the database's user_version.
+    """
+    db_connection = connect()
+    try:
+        cur = db_connection.cursor()
+        cur.execute('PRAGMA user_version;')
+        (version,) = cur.fetchone()
+        for migration_version, path in _migrations():
+            if migration_version <= version:
+                continue
+            utils.log('Applying migration {}', os.path.basename(path))
+            with db_connection, open(path) as migration_file:
+                cur.execute(migration_file.read())
+                # PRAGMA does not accept bindings.
+                cur.execute('PRAGMA user_version = {:d};'.format(migration_version))
+            if migration_version == _OPINION_TEXTS_MIGRATION:
+                # VACUUM cannot run inside a transaction.
+                cur.execute('VACUUM;')
+                report_text_storage(db_connection)
+    finally:
+        db_connection.close()
+
+
+def _migrations():
+    """Returns a sorted list of (version, path) for each migration."""
+    migrations = []
+    for filename in os.listdir(_MIGRATIONS_PATH):
+        if filename.endswith('.sql'):
+            version = int(filename.split('_', 1)[0])
+            migrations.append((version, os.path.join(_MIGRATIONS_PATH, filename)))
+    return sorted(migrations)
+
+
 def connect():
-    return apsw.Connection(_DB_PATH)
+    """Returns a new connection to the database. Most callers should
+    use connection() instead.
+    """
+    db_connection = apsw.Connection(_DB_PATH,
+                                    statementcachesize=STATEMENT_CACHE_SIZE)
+    db_connection.setbusytimeout(BUSY_TIMEOUT)
+    cur = db_connection.cursor()
+    for name, value in _PRAGMAS:
+        # PRAGMA does not accept bindings.
+        cur.execute('PRAGMA {} = {};'.format(name, value))
+    db_connection.createscalarfunction('zlib_compress', compress_text, 1)
+    db_connection.createscalarfunction('zlib_decompress', decompress_text, 1)
+    return db_connection
+
+
+def connection():
+    """Returns the calling thread's connection to the database, which
+    is opened on first use and then reused until close() is called.
+    """
+    db_connection = getattr(_local, 'connection', None)
+    if db_connection is None:
+        db_connection = _local.connection = connect()
+    return db_connection
+
+
+def close():
+    """Closes the calling thread's connection, if it has one."""
+    db_connection = getattr(_local, 'connection', None)
+    if db_connection is not None:
+        _local.connection = None
+        db_connection.close()
+
+
+def compress_text(text):
+    """Returns TEXT, UTF-8 encoded and zlib-compressed, as a blob."""
+    if text is None:
+        return None
+    return buffer(zlib.compress(text.encode('utf8')))
+
+
+def decompress_text(blob):
+    """Returns the text compressed into BLOB by compress_text()."""
+    if blob is None:
+        return None
+    return zlib.decompress(blob).decode('utf8')
+
+
+def get_sync_state(db_connection, name, default=None):
+    cur = db_connection.cursor()
+    cur.execute('SELECT value FROM sync_state WHERE name = ?;', (name,))
+    row = cur.fetchone()
+    return row[0] if row is not None else default
+
+
+def set_sync_state(db_connection, name, value):
+    sql = 'INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?);'
+    with db_connection:
+        db_connection.cursor().execute(sql, (name, value))
+
+
+def get_plain_text(docket_number):
+    """Returns the stored opinion text of the case filing under
+    DOCKET_NUMBER, or None if it has not been inserted.
+    """
+    sql = """
+        SELECT opinion_texts.plain_text
+        FROM case_filings
+        JOIN opinion_texts ON opinion_texts.sha1 = case_filings.sha1
+        WHERE case_filings.docket_number = ?;
+    """
+    cur = connection().cursor()
+    cur.execute(sql, (docket_number,))
+    row = cur.fetchone()
+    return decompress_text(row[0]) if row is not None else None
+
+
+def store_plain_text(db_connection, sha1, plain_text):
+    """Stores PLAIN_TEXT under SHA1 unless a text is already stored
+    under it.
+    """
+    sql = """
+        INSERT OR IGNORE INTO opinion_texts (sha1, plain_text, size)
+        VALUES (?, ?, ?);
+    """
+    if plain_text is None:
+        return
+    db_connection.cursor().execute(sql, (
+        sha1,
+        compress_text(plain_text),
+        len(plain_text.encode('utf8'))
+    ))
+
+
+def delete_unused_plain_texts(db_connection):
+    """Deletes the stored texts that no case filing refers to."""
+    db_connection.cursor().execute("""
+        DELETE FROM opinion_texts
+        WHERE sha1 NOT IN (SELECT sha1 FROM case_filings);
+    """)
 
 
-# Initialize the database if it doesn't exist when this module is imported.
-if not exists():
-    init()
+def report_text_storage(db_connection):
+    """Logs how many bytes compressing and deduplicating the stored
+    opinion texts saves.
+    """
+    cur = db_connection.cursor()
+    cur.execute("""
+        SELECT TOTAL(opinion_texts.size)
+        FROM case_filings
+        JOIN opinion_texts ON opinion_texts.sha1 = case_filings.sha1;
+    """)
+    (uncompressed_size,) = cur.fetchone()
+    cur.execute("""
+        SELECT COUNT(*), TOTAL(LENGTH(plain_text)) FROM opinion_texts;
+    """)
+    (text_count, stored_size) = cur.fetchone()
+    utils.log('Opinion texts: {} stored in {:.1f} MB, {:.1f} MB saved',
+              text_count, stored_size / 1e6,
+              (uncompressed_size - stored_size) / 1e6)
@@ -0,0 +1,258 @@
+"""Agreement chart writers.
+
+A rate chart maps frozenset([shorthand, shorthand]) to the percentage of
+times that pair of justices agrees, or -1 if they never concurred with
+or dissented from each other. Each writer streams a rate chart to a file
+one row at a time, so that only the chart itself is held in memory.
+
+RenderCache remembers a hash of every chart written, so that unchanged
+charts aren't rendered and written again.
+"""
+
+import cgi
+import codecs
+import hashlib
+import json
+import os.path
+
+import utils
+
+
+_CSS_PATH = utils.project_path('chart.css')
+_css = None
+
+
+def css():
+    """Returns the chart stylesheet, which is only read once."""
+    global _css
+    if _css is None:
+        with codecs.open(_CSS_PATH, 'r', 'utf8') as css_file:
+            _css = css_file.read()
+    return _css
+
+
+def rate_rows(chart, justices):
+    """Yields (justice, [(other justice, rate), ...]) for each of
+    JUSTICES but the last, paired with every justice after it.
+    """
+    for i, j1 in enumerate(justices[:-1]):
+        yield j1, [(j2, chart[frozenset([j1.shorthand, j2.shorthand])])
+                   for j2 in justices[i+1:]]
+
+
+def rounded_rate(rate):
+    """Returns RATE rounded to a whole percentage, or None if the pair
+    never agreed or disagreed.
+    """
+    rate = int(round(rate))
+    return None if rate == -1 else rate
+
+
+def rate_class(rate):
+    """Returns the class of a rounded rate in chart.css."""
+    if rate is None:
+        return 'error'
+    elif rate > 90:
+        return 'high'
+    elif rate < 10:
+        return 'low'
+    return None
+
+
+class ChartWriter(object):
+    """Base class of the chart writers. Bump VERSION whenever a writer's
+    output changes, so that cached charts are written again.
+    """
+    extension = None
+    version = 1
+
+    def write(self, f, chart, justices):
+        """Writes CHART of JUSTICES to the file F."""
+        raise NotImplementedError
+
+    def hash(self, chart, justices):
+        """Returns a hash of everything that goes into this writer's
+        rendering of CHART of JUSTICES.
+        """
+        h = hashlib.sha1()
+        h.update('{} {}\n'.format(type(self).__name__, self.version))
+        for j in justices:
+            h.update(u'{}\t{}\n'.format(j.shorthand, j.fullname).encode('utf8'))
+        for _, rates in rate_rows(chart, justices):
+            h.update(repr([rounded_rate(rate) for _, rate in rates]))
+        return h.hexdigest()
+
+
+class HtmlWriter(ChartWriter):
+    extension = 'html'
+    version = 2
+
+    def write(self, f, chart, justices):
+        f.write(u'<style>{}</style>'.format(css()))
+        f.write(u'<table id="agreeTable">')
+        # Top labels
+        f.write(u'<tr><th></th>')
+        for j in justices[1:]:
+            f.write(u'<th>{}</th>'.format(cgi.escape(j.shorthand)))
+        f.write(u'</tr>')
+        # Left labels and chart body
+        for col, (j_left, rates) in enumerate(rate_rows(chart, justices)):
+            f.write(u'<tr>')
+            # Left space
+            if col > 0:
+                f.write(u'<th colspan="{}"></th>'.format(col))
+            # Left label
+            f.write(u'<th>{}</th>'.format(cgi.escape(j_left.shorthand)))
+            # Chart body
+            for _, rate in rates:
+                rate = rounded_rate(rate)
+                klass = rate_class(rate)
+                f.write(u'<td class="{}">'.format(klass) if klass else u'<td>')
+                f.write(u'&#9473;' if rate is None else u'{}%'.format(rate))
+                f.write(u'</td>')
+            f.write(u'</tr>')
+        # The last justice's label, which has no rates of its own.
+        if justices:
+            f.write(u'<tr>')
+            if len(justices) > 1:
+                f.write(u'<th colspan="{}"></th>'.format(len(justices) - 1))
+            f.write(u'<th>{}</th>'.format(cgi.escape(justices[-1].shorthand)))
+            f.write(u'</tr>')
+        f.write(u'</table>')
+
+        f.write(u'<table id="legendTable">')
+        for j in justices:
+            f.write(u'<tr><td>{}</td><td>{}</td></tr>'.format(
+                cgi.escape(j.shorthand), cgi.escape(j.fullname)))
+        f.write(u'</table>')
+
+    def hash(self, chart, justices):
+        h = hashlib.sha1(super(HtmlWriter, self).hash(chart, justices))
+        h.update(css().encode('utf8'))
+        return h.hexdigest()
+
+
+class JsonWriter(ChartWriter):
+    """Writes {"justices": [{"shorthand": ..., "fullname": ...}, ...],
+    "rates": [{"justices": [shorthand, shorthand], "rate": ...}, ...]},
+    where a rate is null if the pair never agreed or disagreed.
+    """
+    extension = 'json'
+
+    def write(self, f, chart, justices):
+        f.write(u'{"justices": [')
+        f.write(u', '.join(
+            json.dumps({'shorthand': j.shorthand, 'fullname': j.fullname})
+            for j in justices
+        ))
+        f.write(u'], "rates": [')
+        separator = u''
+        for j1, rates in rate_rows(chart, justices):
+            for j2, rate in rates:
+                f.write(separator)
+                f.write(json.dumps({'justices': [j1.shorthand, j2.shorthand],
+                                    'rate': rounded_rate(rate)}))
+                separator = u', '
+        f.write(u']}\n')
+
+
+class CsvWriter(ChartWriter):
+    """Writes one justice_1,justice_2,rate row per pair of justices,
+    where the rate is empty if the pair never agreed or disagreed.
+    """
+    extension = 'csv'
+
+    def write(self, f, chart, justices):
+        f.write(u'justice_1,justice_2,rate\r\n')
+        for j1, rates in rate_rows(chart, justices):
+            for j2, rate in rates:
+                rate = rounded_rate(rate)
+                f.write(u'{},{},{}\r\n'.format(
+                    _csv_field(j1.shorthand), _csv_field(j2.shorthand),
+                    '' if rate is None else rate))
+
+
+class SvgWriter(ChartWriter):
+    """Writes the chart as an SVG heatmap laid out like the HTML table,
+    with cells colored like chart.css.
+    """
+    extension = 'svg'
+    cell_width = 60
+    cell_height = 30
+    colors = {
+        'error': '#daa520',
+        'high': '#b1efb1',
+        'low': '#ff9d9d',
+        None: '#ffffff',
+    }
+
+    def write(self, f, chart, justices):
+        size = len(justices)
+        f.write(u'<svg xmlns="http://www.w3.org/2000/svg" width="{}" '
+                u'height="{}" font-family="sans-serif" font-size="12" '
+                u'text-anchor="middle" dominant-baseline="middle">'
+                .format(size * self.cell_width, size * self.cell_height))
+        # Top labels
+        for col, j in enumerate(justices[1:], 1):
+            self._text(f, col, 0, j.shorthand)
+        # Left labels and chart body
+        for row, (j_left, rates) in enumerate(rate_rows(chart, justices), 1):
+            self._text(f, row - 1, row, j_left.shorthand)
+            for col, (_, rate) in enumerate(rates, row):
+                rate = rounded_rate(rate)
+                f.write(u'<rect x="{}" y="{}" width="{}" height="{}" '
+                        u'fill="{}" stroke="#000" stroke-width="2"/>'.format(
+                            col * self.cell_width, row * self.cell_height,
+                            self.cell_width, self.cell_height,
+                            self.colors[rate_class(rate)]))
+                self._text(f, col, row,
+                           u'\u2501' if rate is None else u'{}%'.format(rate))
+        f.write(u'</svg>\n')
+
+    def _text(self, f, col, row, text):
+        f.write(u'<text x="{}" y="{}">{}</text>'.format(
+            (col + 0.5) * self.cell_width, (row + 0.5) * self.cell_height,
+            cgi.escape(text)))
+
+
+WRITERS = {
+    writer.extension: writer
+    for writer in (HtmlWriter, JsonWriter, CsvWriter, SvgWriter)
+}
+
+
+class RenderCache(object):
+    """Chart name => (hash, path) of the last chart written under that
+    name, kept in a JSON file next to the charts.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as cache_file:
+                self._renders = json.load(cache_file)
+        except (IOError, ValueError):
+            self._renders = {}
+
+    def is_current(self, name, chart_hash):
+        """Returns the path of the chart last written under NAME if its
+        hash is CHART_HASH and it still exists, or None otherwise.
+        """
+        render = self._renders.get(name)
+        if render and render['hash'] == chart_hash \
+                and os.path.isfile(render['path']):
+            return render['path']
+        return None
+
+    def set(self, name, chart_hash, path):
+        self._renders[name] = {'hash': chart_hash, 'path': path}
+
+    def save(self):
+        with open(self.path, 'w') as cache_file:
+            json.dump(self._renders, cache_file, indent=2, sort_keys=True)
+
+
+def _csv_field(value):
+    if any(c in value for c in u',"\r\n'):
+        return u'"{}"'.format(value.replace(u'"', u'""'))
+    return value
@@ -1,19 +1,18 @@
-from calendar import timegm
-from datetime import datetime
-from email.utils import formatdate, parsedate
+"""CourtListener API endpoints and helpers for requesting them. The
+HTTP session itself is set up by session.py, which is only imported by
+the commands that go over the network.
+"""
+
 import os
 import urllib
 
-from cachecontrol import CacheControl
-from cachecontrol.caches.file_cache import FileCache
-from cachecontrol.heuristics import BaseHeuristic
-import requests
-
 import date
 import utils
 
 
-COURTLISTENER_BASE_URL = 'https://www.courtlistener.com'
+# Can be pointed at a local stub server for testing.
+COURTLISTENER_BASE_URL = os.environ.get('COURTLISTENER_BASE_URL',
+                                        'https://www.courtlistener.com')
 COURTLISTENER_REST_API = COURTLISTENER_BASE_URL + '/api/rest/v3'
 
 DOCKET_LIST_ENDPOINT = COURTLISTENER_REST_API + '/dockets/'
@@ -21,8 +20,10 @@ DOCKET_LIST_FILTERS = {
     'court': 'cal',
     'clusters__date_filed__gte': date.DEFAULT_START_DATE,
     'order_by': ['-date_modified', '-date_created'],
+    'fields': ['id', 'docket_number', 'date_modified', 'clusters'],
 }
 OPINION_CLUSTER_ENDPOINT = COURTLISTENER_REST_API + '/clusters/{}/'  # {} is ID
+OPINION_CLUSTER_LIST_ENDPOINT = COURTLISTENER_REST_API + '/clusters/'
 OPINION_CLUSTER_FILTERS = {
     # As of 25-Jun-2019, the CourtListener API implementation always
     # sets the following fields as such, but would be useful for our
@@ -33,31 +34,26 @@ OPINION_CLUSTER_FILTERS = {
                'date_filed_is_approximate']
 }
 OPINION_INSTANCE_ENDPOINT = COURTLISTENER_REST_API + '/opinions/{}/'  # {} is ID
+OPINION_LIST_ENDPOINT = COURTLISTENER_REST_API + '/opinions/'
 OPINION_INSTANCE_FILTERS = {
     # As of 25-Jun-2019, the CourtListener API implementation always
     # sets the following fields as such, but would be useful for our
     # purposes if the implementation changes in the future:
     # - author, joined_by, author_str: empty/null
     # - type: '010combined'
+    # plain_text is fetched separately (see OPINION_TEXT_FILTERS) and
+    # only when the sha1 differs from the stored one.
     'fields': ['id', 'author', 'joined_by', 'author_str', 'type', 'sha1',
-               'download_url', 'plain_text'],
+               'download_url'],
+}
+OPINION_TEXT_FILTERS = {
+    'fields': ['id', 'sha1', 'plain_text'],
 }
 
 DEFAULT_REQUESTS_HEADER = {'Accept': 'application/json'}
-
-
-class CacheHeuristic(BaseHeuristic):
-    def update_headers(self, response):
-        response_date = parsedate(response.headers['date'])
-        expires_local = date.next_posting_date(datetime(*response_date[:6]))
-        expires_utc = date.local_to_utc(expires_local)
-        return {
-            'expires': formatdate(timegm(expires_utc.timetuple())),
-            'cache-control': 'public',
-        }
-
-    def warning(self, response):
-        return '110 - "automatically cached, response is stale"'
+# Number of pages of docket entries whose opinions are fetched at the
+# same time.
+DEFAULT_CONCURRENCY = 4
 
 
 def filters_to_url_params(filter_dict, begin='?'):
@@ -87,34 +83,55 @@ def filters_to_url_params(filter_dict, begin='?'):
     return begin + '&'.join(params)
 
 
+def url_id(url):
+    """Returns the last path segment of an API URL, e.g. 'cal' for
+    '.../api/rest/v3/courts/cal/', or None if there is no URL.
+    """
+    if not url:
+        return None
+    return url.rstrip('/').rsplit('/', 1)[-1]
+
+
+def get_all_results(http_session, endpoint, filter_dict):
+    """Returns the results of every page of the list ENDPOINT filtered
+    by FILTER_DICT.
+    """
+    results = []
+    url = endpoint + filters_to_url_params(filter_dict)
+    while url:
+        response = get_response_json(http_session.get(url))
+        results.extend(response['results'])
+        url = response.get('next')
+    return results
+
+
 def get_requests_header():
+    """Returns the headers of every API request, with the token from
+    the COURTLISTENER_API_TOKEN environment variable or, if unset,
+    config/courtlistener_api.token.
+    """
     header = DEFAULT_REQUESTS_HEADER.copy()
-    token_filepath = utils.project_path('config', 'courtlistener_api.token')
-    with open(token_filepath, 'r', 1) as token_file:
-        token = token_file.read().strip()
-        header['Authorization'] = 'Token {}'.format(token)
+    token = os.environ.get('COURTLISTENER_API_TOKEN')
+    if not token:
+        token_filepath = utils.project_path('config', 'courtlistener_api.token')
+        with open(token_filepath, 'r', 1) as token_file:
+            token = token_file.read().strip()
+    header['Authorization'] = 'Token {}'.format(token)
     return header
 
 
 def get_response_json(response):
+    # Imported here so that importing this module doesn't load requests.
+    import requests
+
     try:
         response.raise_for_status()  # HTTPError
         return response.json()  # ValueError
     except requests.HTTPError as e:
+        # Retryable errors only get here once retries are exhausted.
         if response.status_code == 429:
             utils.error(e, 'API request quota reached. Is the CourtListener API token set?')
         else:
-            raise NotImplementedError(e)  # TODO
+            utils.error(e, 'Request to {} failed', response.url)
     except ValueError as e:
-        raise NotImplementedError(e)  # TODO
-
-
-def start_http_session():
-    # Start the cached HTTP Session.
-    # Cache directory will be created if it doesn't exist.
-    cache_path = utils.project_path('.cache')
-    http_session = CacheControl(requests.Session(),
-                                heuristic=CacheHeuristic(),
-                                cache=FileCache(cache_path))
-    http_session.headers = get_requests_header()
-    return http_session
+        utils.error(e, 'Response from {} is not valid JSON', response.url)
@@ -0,0 +1,183 @@
+import apsw
+import sqlite3
+
+import metrics
+from .models import Justice
+import utils
+
+
+# Number of case filings written per transaction.
+DEFAULT_BATCH_SIZE = 50
+
+
+class BatchWriter(object):
+    """Writes case filings, their opinions and their concurrences to the
+    database in transactions of BATCH_SIZE case filings, so that a sync
+    commits once per batch rather than at least twice per case filing.
+
+    Use as a context manager, or call flush() once done, so that the
+    last, partial batch is written as well. The case filings that
+    couldn't be written are then in `failed`, and watermark() tells how
+    far a sync can be considered done.
+    """
+
+    def __init__(self, db_connection, batch_size=DEFAULT_BATCH_SIZE):
+        self.db_connection = db_connection
+        self.batch_size = batch_size
+        self._case_filings = []
+        # Docket numbers of the case filings that couldn't be written
+        self.failed = []
+        # Oldest `modified_on` of those
+        self._failed_since = None
+        # `modified_on` of the case filings written
+        self._written_modified_ons = set()
+
+    def add(self, case_filing):
+        self._case_filings.append(case_filing)
+        if len(self._case_filings) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._case_filings:
+            return
+        # Includes the commit.
+        with metrics.span('write_batch'), self.db_connection:
+            inserted_opinions = []
+            for case_filing in self._case_filings:
+                # Each case filing is still written in a savepoint of
+                # its own, so a failing one doesn't abort the batch. Its
+                # row is inserted there too, rather than with the
+                # others' in an executemany(), so that it is rolled
+                # back with its opinions, which are inserted one by one
+                # for their rowids (see Opinion.insert()).
+                with metrics.span('insert_case'):
+                    opinions = insert_case(self.db_connection, case_filing)
+                if opinions is None:
+                    self._add_failed(case_filing)
+                    continue
+                self._written_modified_ons.add(case_filing.modified_on)
+                inserted_opinions.extend(opinions)
+            if inserted_opinions:
+                with metrics.span('insert_concurrences'):
+                    insert_concurrences(self.db_connection, inserted_opinions)
+        utils.log('Committed {} case filings', len(self._case_filings))
+        self._case_filings = []
+
+    def watermark(self, watermark):
+        """Returns the sync watermark advanced from WATERMARK to the
+        latest `modified_on` written. If some case filings couldn't be
+        written, it's only advanced to the latest one before the oldest
+        of those, so that the next sync fetches them again.
+        """
+        written = self._written_modified_ons
+        if self._failed_since is not None:
+            written = [modified_on for modified_on in written
+                       if modified_on < self._failed_since]
+        return max([watermark] + list(written))
+
+    def _add_failed(self, case_filing):
+        self.failed.append(case_filing.docket_number)
+        if self._failed_since is None \
+                or case_filing.modified_on < self._failed_since:
+            self._failed_since = case_filing.modified_on
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+def insert_case(db_connection, case_filing):
+    # Begin and commit transaction (or savepoint, within a batch) for
+    # inserting (or re-ingesting) the case filing and its opinions.
+    inserted_opinions = []
+    try:
+        with db_connection:
+            stored = case_filing.fetch_stored(db_connection)
+            if stored is None:
+                case_filing.insert(db_connection)
+                outcome = 'inserted'
+            else:
+                stored_sha1, stored_modified_on = stored
+                if stored_modified_on == case_filing.modified_on:
+                    utils.log('{} is up to date', case_filing)
+                    metrics.increment('case_filings_up_to_date')
+                    return inserted_opinions
+                # The opinions only need to be replaced if the opinion
+                # itself has changed, not just the docket.
+                text_changed = stored_sha1 != case_filing.sha1
+                # Unless a reviewer corrected them.
+                opinions_replaced = case_filing.update(db_connection,
+                                                       text_changed)
+                outcome = 'updated'
+                if not opinions_replaced:
+                    metrics.increment('case_filings_updated')
+                    return inserted_opinions
+            for opinion in case_filing.opinions:
+                # Case Filing has no opinions.
+                if opinion is None:
+                    break
+                if opinion.insert(db_connection):
+                    inserted_opinions.append(opinion)
+    except (apsw.Error, sqlite3.Error) as e:
+        msg = 'Unable to insert {}: {}'
+        utils.warn(msg, case_filing.docket_number, e)
+        metrics.increment('case_filings_failed')
+        # Case filing and opinions not inserted, so no
+        # concurrences to insert.
+        return None
+    metrics.increment('case_filings_' + outcome)
+    metrics.increment('opinions_inserted', len(inserted_opinions))
+    return inserted_opinions
+
+
+def insert_concurrences(db_connection, opinions):
+    """Inserts the concurrences of OPINIONS, which may belong to several
+    case filings, with a single executemany().
+    """
+    assert len(opinions), 'There should always be at least one opinion (majority).'
+    # Insert concurrences.
+    sql = """
+        INSERT INTO concurrences (
+            opinion_id,
+            justice
+        )
+        VALUES (?, ?);
+    """
+    concurrences = []
+    for op in opinions:
+        # Insert a concurrence row for each concurring justice.
+        # TODO: move this to Opinion constructor?
+        concurring_justices, unknown_names = \
+            Justice.resolve(op.concurring_justices)
+        for name in unknown_names:
+            utils.warn("Unknown concurring justice '{}'", name)
+        concurrences.extend((op.id, concurring_justice.shorthand)
+                            for concurring_justice in concurring_justices)
+    assert len(concurrences), 'There are no concurrences; the majority opinion always has some.'
+    utils.log('Inserting {} concurrences', len(concurrences))
+    try:
+        with db_connection:
+            db_connection.cursor().executemany(sql, concurrences)
+        metrics.increment('concurrences_inserted', len(concurrences))
+    except apsw.ConstraintError:
+        # The executemany() was rolled back, so insert the concurrences
+        # one by one to warn about each one that violates a constraint.
+        _insert_each(db_connection, sql, concurrences)
+    except (apsw.Error, sqlite3.Error) as e:
+        msg = 'Could not insert concurrences for {}: {}'
+        docket_numbers = sorted({op.case_filing.docket_number for op in opinions})
+        utils.warn(msg, ', '.join(docket_numbers), e)
+
+
+def _insert_each(db_connection, sql, rows):
+    with db_connection:
+        cur = db_connection.cursor()
+        for row in rows:
+            try:
+                cur.execute(sql, row)
+                metrics.increment('concurrences_inserted')
+            except apsw.ConstraintError as e:
+                utils.warn(str(e))
@@ -13,7 +13,7 @@ CREATE TABLE justices (
 CREATE TABLE case_filings (
     docket_number       VARCHAR(255)    PRIMARY KEY,
     url                 VARCHAR(255)                    NOT NULL,
-    plain_text          CLOB                            NOT NULL,
+    plain_text          CLOB                            NOT NULL,  -- Always empty; see migrations/003_opinion_texts.sql
 -- TODO: Use to check for updates?
     sha1                VARCHAR(255)                    NOT NULL,
 -- When the filing was officially filed.
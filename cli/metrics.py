@@ -0,0 +1,196 @@
+"""Timings and counters of where a command spends its time.
+
+Stages are timed with span(), and events such as HTTP requests, cache
+hits and rows written are counted with increment(). Both only take a
+lock and a few additions, so they are left in hot paths. Once a command
+is done, what was collected may be written as JSON lines with
+write_json() and as a Prometheus textfile, e.g. for node_exporter's
+textfile collector, with write_textfile().
+
+Stages passed to enable_profiling() are also run under cProfile, and
+their profiles written by write_profiles() for pstats or snakeviz.
+"""
+
+import cProfile
+from contextlib import contextmanager
+import json
+import os
+import os.path
+import pstats
+import sys
+import threading
+from time import time
+
+import utils
+
+
+# Prefix of the Prometheus metric names.
+PROMETHEUS_PREFIX = 'scoca'
+
+_lock = threading.Lock()
+# Stage => [count, total seconds, max seconds]
+_spans = {}
+# Counter => value
+_counters = {}
+# Stage => pstats.Stats of its profiled spans so far
+_profiles = {}
+_profiled_stages = frozenset()
+# Whether the calling thread is being profiled already, since cProfile
+# only profiles one Profile per thread at a time.
+_local = threading.local()
+
+
+@contextmanager
+def span(stage):
+    """Times the enclosed block as one span of STAGE, and profiles it if
+    STAGE is profiled (unless a profiled span encloses it already).
+    """
+    profile = None
+    if stage in _profiled_stages and not getattr(_local, 'profiling', False):
+        profile = cProfile.Profile()
+        _local.profiling = True
+        profile.enable()
+    started_at = time()
+    try:
+        yield
+    finally:
+        record(stage, time() - started_at)
+        if profile is not None:
+            profile.disable()
+            _local.profiling = False
+            with _lock:
+                if stage in _profiles:
+                    _profiles[stage].add(profile)
+                else:
+                    _profiles[stage] = pstats.Stats(profile)
+
+
+def record(stage, seconds):
+    """Records a span of STAGE that took SECONDS, e.g. as timed by a
+    worker process.
+    """
+    with _lock:
+        timings = _spans.get(stage)
+        if timings is None:
+            _spans[stage] = [1, seconds, seconds]
+        else:
+            timings[0] += 1
+            timings[1] += seconds
+            timings[2] = max(timings[2], seconds)
+
+
+def increment(counter, n=1):
+    with _lock:
+        _counters[counter] = _counters.get(counter, 0) + n
+
+
+def enable_profiling(stages):
+    """Profiles the spans of each of STAGES from now on."""
+    global _profiled_stages
+    _profiled_stages = frozenset(stages or ())
+
+
+def reset():
+    """Forgets every span, counter and profile collected so far."""
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _profiles.clear()
+
+
+def snapshot():
+    """Returns what was collected so far, as a dict with a `spans` dict
+    of stage => {count, seconds, max_seconds}, and a `counters` dict.
+    """
+    with _lock:
+        return {
+            'spans': {
+                stage: {'count': count, 'seconds': seconds,
+                        'max_seconds': max_seconds}
+                for stage, (count, seconds, max_seconds) in _spans.iteritems()
+            },
+            'counters': dict(_counters),
+        }
+
+
+def write_json(path, **labels):
+    """Writes one JSON object per stage and per counter to the file at
+    PATH, or to stdout if PATH is '-', each with the given LABELS.
+    """
+    metrics = snapshot()
+    lines = []
+    now = time()
+    for stage, timings in sorted(metrics['spans'].iteritems()):
+        line = dict(labels, time=now, type='span', name=stage)
+        line.update(timings)
+        lines.append(line)
+    for counter, value in sorted(metrics['counters'].iteritems()):
+        lines.append(dict(labels, time=now, type='counter', name=counter,
+                          value=value))
+    if path == '-':
+        _write_json_lines(sys.stdout, lines)
+    else:
+        with open(path, 'a') as json_file:
+            _write_json_lines(json_file, lines)
+
+
+def write_textfile(path, **labels):
+    """Writes what was collected so far to the file at PATH in the
+    Prometheus text format, each sample with the given LABELS. The file
+    is replaced in one go, so that it is never scraped half-written.
+    """
+    metrics = snapshot()
+    lines = []
+
+    def add(name, type_, help_, samples):
+        name = '{}_{}'.format(PROMETHEUS_PREFIX, name)
+        lines.append('# HELP {} {}'.format(name, help_))
+        lines.append('# TYPE {} {}'.format(name, type_))
+        for sample_labels, value in samples:
+            lines.append('{}{} {!r}'.format(
+                name, _prometheus_labels(dict(labels, **sample_labels)), value
+            ))
+
+    spans = sorted(metrics['spans'].iteritems())
+    add('stage_spans_total', 'counter', 'Spans timed per stage.',
+        [({'stage': stage}, t['count']) for stage, t in spans])
+    add('stage_seconds_total', 'counter', 'Seconds spent per stage.',
+        [({'stage': stage}, t['seconds']) for stage, t in spans])
+    add('stage_max_seconds', 'gauge', 'Longest span per stage.',
+        [({'stage': stage}, t['max_seconds']) for stage, t in spans])
+    for counter, value in sorted(metrics['counters'].iteritems()):
+        add(counter + '_total', 'counter', counter.replace('_', ' ') + '.',
+            [({}, value)])
+    add('last_run_timestamp_seconds', 'gauge',
+        'When the metrics were written.', [({}, time())])
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as textfile:
+        textfile.write('\n'.join(lines) + '\n')
+    os.rename(tmp_path, path)
+
+
+def write_profiles(dir_path):
+    """Writes the profile of each profiled stage to DIR_PATH, as
+    profile_<stage>.prof.
+    """
+    with _lock:
+        profiles = sorted(_profiles.iteritems())
+    for stage, stats in profiles:
+        path = os.path.join(dir_path, 'profile_{}.prof'.format(stage))
+        stats.dump_stats(path)
+        utils.log('Saved the profile of stage {} to "{}"', stage, path)
+
+
+def _write_json_lines(f, lines):
+    for line in lines:
+        f.write(json.dumps(line, sort_keys=True) + '\n')
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+        for k, v in sorted(labels.iteritems())
+    ))
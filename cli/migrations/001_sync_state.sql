@@ -0,0 +1,8 @@
+----- SYNC STATE -----
+
+-- State carried over from one sync to the next, e.g. the latest
+-- `date_modified` of the docket entries that have been synced.
+CREATE TABLE sync_state (
+    name    VARCHAR(255)    PRIMARY KEY,
+    value   VARCHAR(255)
+);
@@ -0,0 +1,76 @@
+----- AGREEMENT COUNTS -----
+
+-- Each docket's contribution to the agreement chart: the number of
+-- times each pair of justices (justice_1 < justice_2) concurs, and the
+-- number of times they concur or dissent.
+CREATE TABLE agreement_counts (
+    docket_number   VARCHAR(255)    NOT NULL,
+    justice_1       VARCHAR(5)      NOT NULL,
+    justice_2       VARCHAR(5)      NOT NULL,
+    concur_count    INTEGER         NOT NULL,
+    total_count     INTEGER         NOT NULL,
+
+    CONSTRAINT PK_AgreementCounts
+        PRIMARY KEY (docket_number, justice_1, justice_2)
+);
+
+-- Dockets whose agreement counts need to be recounted. Maintained by
+-- the triggers below so that changes made by the Admin Interface are
+-- picked up as well.
+CREATE TABLE stale_agreement_counts (
+    docket_number   VARCHAR(255)    PRIMARY KEY
+);
+
+INSERT INTO stale_agreement_counts (docket_number)
+    SELECT DISTINCT docket_number FROM opinions;
+
+CREATE TRIGGER TR_Opinions_AfterInsert_AgreementCounts
+    AFTER INSERT ON opinions
+    FOR EACH ROW
+    BEGIN
+        INSERT OR IGNORE INTO stale_agreement_counts (docket_number)
+            VALUES (NEW.docket_number);
+    END;
+
+CREATE TRIGGER TR_Opinions_AfterDelete_AgreementCounts
+    AFTER DELETE ON opinions
+    FOR EACH ROW
+    BEGIN
+        INSERT OR IGNORE INTO stale_agreement_counts (docket_number)
+            VALUES (OLD.docket_number);
+    END;
+
+CREATE TRIGGER TR_Opinions_AfterUpdate_AgreementCounts
+    AFTER UPDATE OF docket_number, type_id, effective_type_id, authoring_justice
+    ON opinions
+    FOR EACH ROW
+    BEGIN
+        INSERT OR IGNORE INTO stale_agreement_counts (docket_number)
+            VALUES (OLD.docket_number);
+        INSERT OR IGNORE INTO stale_agreement_counts (docket_number)
+            VALUES (NEW.docket_number);
+    END;
+
+CREATE TRIGGER TR_Concurrences_AfterInsert_AgreementCounts
+    AFTER INSERT ON concurrences
+    FOR EACH ROW
+    BEGIN
+        INSERT OR IGNORE INTO stale_agreement_counts (docket_number)
+            SELECT docket_number FROM opinions WHERE id = NEW.opinion_id;
+    END;
+
+CREATE TRIGGER TR_Concurrences_AfterDelete_AgreementCounts
+    AFTER DELETE ON concurrences
+    FOR EACH ROW
+    BEGIN
+        INSERT OR IGNORE INTO stale_agreement_counts (docket_number)
+            SELECT docket_number FROM opinions WHERE id = OLD.opinion_id;
+    END;
+
+CREATE TRIGGER TR_Concurrences_AfterUpdate_AgreementCounts
+    AFTER UPDATE ON concurrences
+    FOR EACH ROW
+    BEGIN
+        INSERT OR IGNORE INTO stale_agreement_counts (docket_number)
+            SELECT docket_number FROM opinions WHERE id IN (OLD.opinion_id, NEW.opinion_id);
+    END;
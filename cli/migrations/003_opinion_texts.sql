@@ -0,0 +1,22 @@
+----- OPINION TEXTS -----
+
+-- Opinion texts, zlib-compressed and keyed by the sha1 CourtListener
+-- computes for them, so that each distinct text is stored only once.
+-- Replaces case_filings.plain_text, which is left empty.
+CREATE TABLE opinion_texts (
+    sha1        VARCHAR(255)    PRIMARY KEY,
+    plain_text  BLOB            NOT NULL,
+-- Size of the uncompressed text, in bytes.
+    size        INTEGER         NOT NULL
+);
+
+CREATE INDEX IDX_CaseFilings_Sha1
+    ON case_filings (sha1);
+
+-- zlib_compress() is registered by db.connect().
+INSERT OR IGNORE INTO opinion_texts (sha1, plain_text, size)
+    SELECT sha1, zlib_compress(plain_text), LENGTH(CAST(plain_text AS BLOB))
+    FROM case_filings
+    WHERE plain_text != '';
+
+UPDATE case_filings SET plain_text = '' WHERE plain_text != '';
@@ -0,0 +1,6 @@
+----- CASE FILING PAGES -----
+
+-- Matches the order of the API's pages of case filings, newest first, so
+-- that each page is read off the index without sorting.
+CREATE INDEX IDX_CaseFilings_FiledOnDocketNumber
+    ON case_filings (filed_on, docket_number);
@@ -0,0 +1,44 @@
+----- OPINION SEARCH -----
+
+-- Full-text index of the opinion texts, for `python -m cli search` and
+-- /api/search. It is contentless, as the texts are already stored
+-- (compressed) in `opinion_texts`; snippets are made from those.
+CREATE VIRTUAL TABLE opinion_search USING fts5(
+    plain_text,
+    content=''
+);
+
+-- The sha1 of the text indexed under each row of `opinion_search`.
+CREATE TABLE opinion_search_texts (
+    id      INTEGER         PRIMARY KEY,
+    sha1    VARCHAR(255)    NOT NULL    UNIQUE
+);
+
+-- Keep the index in sync with `opinion_texts`, whose rows are only ever
+-- inserted and deleted. A contentless index needs the text it indexed
+-- to delete it. zlib_decompress() is registered by db.connect().
+CREATE TRIGGER TR_OpinionTexts_Insert AFTER INSERT ON opinion_texts
+BEGIN
+    INSERT INTO opinion_search_texts (sha1) VALUES (new.sha1);
+    INSERT INTO opinion_search (rowid, plain_text)
+        SELECT id, zlib_decompress(new.plain_text)
+        FROM opinion_search_texts
+        WHERE sha1 = new.sha1;
+END;
+
+CREATE TRIGGER TR_OpinionTexts_Delete BEFORE DELETE ON opinion_texts
+BEGIN
+    INSERT INTO opinion_search (opinion_search, rowid, plain_text)
+        SELECT 'delete', id, zlib_decompress(old.plain_text)
+        FROM opinion_search_texts
+        WHERE sha1 = old.sha1;
+    DELETE FROM opinion_search_texts WHERE sha1 = old.sha1;
+END;
+
+INSERT INTO opinion_search_texts (sha1)
+    SELECT sha1 FROM opinion_texts;
+
+INSERT INTO opinion_search (rowid, plain_text)
+    SELECT opinion_search_texts.id, zlib_decompress(opinion_texts.plain_text)
+    FROM opinion_search_texts
+    JOIN opinion_texts ON opinion_texts.sha1 = opinion_search_texts.sha1;
@@ -0,0 +1,13 @@
+----- PARSE RESULTS -----
+
+-- What regex.parse_opinions() returned for each stored text, as JSON,
+-- by version of the parser (regex.PARSER_VERSION), so that `python -m
+-- cli reparse` parses a text only once per version.
+CREATE TABLE parse_results (
+    sha1            VARCHAR(255)    NOT NULL,
+    parser_version  VARCHAR(255)    NOT NULL,
+    opinions        TEXT            NOT NULL,
+
+    CONSTRAINT PK_ParseResults
+        PRIMARY KEY (sha1, parser_version)
+);
@@ -2,26 +2,64 @@ from enum import Enum, unique
 import string
 
 import apsw
-import requests
 
+import db
 from .http import (
     COURTLISTENER_BASE_URL, OPINION_CLUSTER_FILTERS, OPINION_INSTANCE_FILTERS,
-    filters_to_url_params, get_response_json
+    OPINION_TEXT_FILTERS, filters_to_url_params, get_response_json
 )
+import metrics
 import regex
 import utils
 
 
+JUSTICES_CSV_PATH = utils.project_path('config', 'justices.csv')
+
+
 def _assert_unit_list(obj):
     if not isinstance(obj, list) or len(obj) != 1:
         raise ValueError  # TODO (custom unexpected value error?)
 
 
+def _get(http_session, endpoint, filter_dict):
+    if http_session is None:
+        # Imported here so that loading models doesn't load requests.
+        import requests
+        http_session = requests
+    filtered_endpoint = endpoint + filters_to_url_params(filter_dict)
+    response = http_session.get(filtered_endpoint)
+    return get_response_json(response)
+
+
+def _fetch_opinion_cluster(http_session, docket_entry):
+    clusters = docket_entry.get('clusters')
+    _assert_unit_list(clusters)
+    return _get(http_session, clusters[0], OPINION_CLUSTER_FILTERS)
+
+
+def _fetch_opinion(http_session, opinion_cluster):
+    """Fetches the opinion's metadata, without its plain text."""
+    opinions = opinion_cluster.get('sub_opinions')
+    _assert_unit_list(opinions)
+    return _get(http_session, opinions[0], OPINION_INSTANCE_FILTERS)
+
+
+def _fetch_plain_text(http_session, opinion_cluster):
+    opinions = opinion_cluster.get('sub_opinions')
+    opinion_text = _get(http_session, opinions[0], OPINION_TEXT_FILTERS)
+    return opinion_text.get('plain_text')
+
+
 class _Insertable(object):
+    __slots__ = ()
+
     def insert(self, db_connection):
         raise NotImplementedError
 
     def _insert(self, db_connection, sql, bindings):
+        """Returns True if the row was inserted, or False if it violated
+        a constraint.
+        """
         utils.log('Inserting {}', self)
         cur = db_connection.cursor()
         try:
@@ -30,27 +68,41 @@ class _Insertable(object):
             # Usually, this means it already exists in the database, so
             # just raise a warning just in case.
             utils.warn(str(e))
-        return cur
+            return False
+        return True
 
 
 class _Flagable(object):
+    __slots__ = ()
+
     def flag(self, msg):
         utils.log('FLAGGED {}: {}', str(self), msg)
 
 
 class Justice(_Insertable):
+    """A justice, registered on creation under a dense integer index
+    (in order of registration) so that a set of justices can be stored
+    as a bitmask with bit INDEX set for each (see mask()).
+    """
     _all = []
     _all_by_shorthand = dict()
     _all_by_short_name = dict()
+    _all_by_folded_short_name = dict()
+    _name_matcher = None
 
     def __init__(self, shorthand, short_name, fullname):
         self.shorthand = shorthand
         self.short_name = short_name
         self.fullname = fullname
+        self.index = len(Justice._all)
+        self.bit = 1 << self.index
         # Cache the justice by shorthand and short name for lookup.
         Justice._all.append(self)
         Justice._all_by_shorthand[shorthand] = self
         Justice._all_by_short_name[short_name] = self
+        Justice._all_by_folded_short_name[regex.fold(short_name)] = self
+        # The matcher no longer knows all short names.
+        Justice._name_matcher = None
 
     @staticmethod
     def get(justice):
@@ -59,7 +111,86 @@ class Justice(_Insertable):
         elif justice in Justice._all_by_short_name:
             return Justice._all_by_short_name.get(justice)
         else:
-            return None
+            # E.g. 'Cuellar' or 'CHIN'
+            return Justice._all_by_folded_short_name.get(regex.fold(justice))
+
+    @staticmethod
+    def mask(justices):
+        """Returns the bitmask of JUSTICES, given as anything get()
+        accepts. Unrecognized justices are left out.
+        """
+        mask = 0
+        for justice in justices:
+            justice = Justice.get(justice)
+            if justice is not None:
+                mask |= justice.bit
+        return mask
+
+    @staticmethod
+    def resolve(names):
+        """Returns the justices named in NAMES, in order and without
+        duplicates, and the names that aren't (wholly) recognized. A name
+        that isn't recognized is searched for short names, in case it is
+        several names run together, e.g. due to a missing comma.
+        """
+        justices = []
+        unknown_names = []
+        for name in names:
+            justice = Justice.get(name)
+            if justice is not None:
+                found = [justice]
+            else:
+                found_names, unknown_fragments = \
+                    Justice.name_matcher().findall_and_reduce(name)
+                found = [Justice.get(n) for n in found_names]
+                if unknown_fragments:
+                    unknown_names.append(name)
+            justices.extend(j for j in found if j not in justices)
+        return justices, unknown_names
+
+    @staticmethod
+    def from_mask(mask):
+        """Returns the justices in MASK, in order of index."""
+        return [j for j in Justice._all if mask & j.bit]
+
+    @staticmethod
+    def name_matcher():
+        """Returns a regex.NameMatcher of all short names."""
+        if Justice._name_matcher is None:
+            Justice._name_matcher = regex.NameMatcher(Justice.all_short_names())
+        return Justice._name_matcher
+
+    @staticmethod
+    def load(db_connection):
+        """Loads every justice stored in the database, in the order they
+        were inserted, unless justices have already been loaded.
+        """
+        if Justice._all:
+            return
+        cur = db_connection.cursor()
+        cur.execute("""
+            SELECT shorthand, short_name, fullname
+            FROM justices
+            ORDER BY rowid;
+        """)
+        for shorthand, short_name, fullname in cur.fetchall():
+            Justice(shorthand, short_name, fullname)
+
+    @staticmethod
+    def populate(db_connection, justices_path=JUSTICES_CSV_PATH):
+        """Registers every justice in the CSV file at JUSTICES_PATH and
+        inserts those that aren't stored yet.
+        """
+        import unicodecsv as csv  # This helps fix unicode issues.
+
+        with db_connection, open(justices_path, 'rb') as justices_csv:
+            justices_reader = csv.DictReader(justices_csv)
+            # TODO: change?
+            for row in justices_reader:
+                justice = Justice._all_by_shorthand.get(row['shorthand']) \
+                          or Justice(row['shorthand'], row['short_name'],
+                                     row['fullname'])
+                justice.insert(db_connection)
 
     @staticmethod
     def all():
@@ -71,12 +202,12 @@ class Justice(_Insertable):
 
     def insert(self, db_connection):
         sql = """
-            INSERT INTO justices (
+            INSERT OR IGNORE INTO justices (
                 shorthand,
                 short_name,
                 fullname
             )
-            VALUES (?, ?, ?); 
+            VALUES (?, ?, ?);
         """
         self._insert(db_connection, sql, (
             self.shorthand,
@@ -89,38 +220,99 @@ class Justice(_Insertable):
 
 
 class CaseFiling(_Insertable, _Flagable):
-    def __init__(self, docket_entry, http_session=requests):
+    """A case filing of the docket and its opinions. Only the fields
+    that are stored are kept, rather than the API's JSON, and the plain
+    text is released once stored (and loaded again if needed), so that
+    a sync's memory use doesn't grow with the opinions' length.
+    """
+    __slots__ = (
+        'docket_number', 'url', 'sha1', 'filed_on', 'modified_on',
+        'opinions', 'is_unchanged', 'needs_parsing', '_plain_text',
+        '_text_stored',
+    )
+
+    def __init__(self, docket_entry, http_session=None, stored_sha1=None,
+                 parse=True, opinion_cluster=None, opinion=None):
+        """STORED_SHA1 is the sha1 of the opinion as stored in the
+        database, if any. The opinion's plain text is only downloaded
+        and parsed if its sha1 differs from STORED_SHA1.
+
+        If not PARSE, the plain text is left for the caller to parse
+        with regex.parse_opinions() and hand to set_parsed_opinions(),
+        e.g. in another process.
+
+        HTTP_SESSION defaults to the requests module itself. The opinion
+        cluster and opinion (with its plain text) are only fetched if
+        OPINION_CLUSTER and OPINION aren't given, e.g. from bulk data.
+        """
         self.opinions = []
+        self.docket_number = docket_entry.get('docket_number')
+        self.modified_on = docket_entry.get('date_modified')
+
+        if opinion_cluster is None:
+            opinion_cluster = _fetch_opinion_cluster(http_session,
+                                                     docket_entry)
+        abs_url = opinion_cluster.get('absolute_url')
+        self.url = COURTLISTENER_BASE_URL + abs_url if abs_url else None
+        self.filed_on = opinion_cluster.get('date_filed')
+
+        fetch_plain_text = opinion is None
+        if opinion is None:
+            opinion = _fetch_opinion(http_session, opinion_cluster)
+        self.sha1 = opinion.get('sha1')
+
+        self._plain_text = None
+        self.is_unchanged = stored_sha1 is not None and self.sha1 == stored_sha1
+        # Whether the plain text can be loaded from the database.
+        self._text_stored = self.is_unchanged
+        # Unchanged opinions are neither downloaded nor parsed again.
+        self.needs_parsing = not self.is_unchanged
+        if not self.is_unchanged:
+            if fetch_plain_text:
+                self._plain_text = _fetch_plain_text(http_session,
+                                                     opinion_cluster)
+            else:
+                self._plain_text = opinion.get('plain_text')
+            if parse:
+                with metrics.span('parse_opinions'):
+                    parsed_opinions = regex.parse_opinions(self.plain_text)
+                self.set_parsed_opinions(parsed_opinions)
 
-        self._docket_entry = docket_entry
-        self._http_session = http_session
-        self._opinion_cluster = None
-        self._opinion = None
-
-        self._fetch_opinion_cluster()
-        self._fetch_opinion()
-        self._parse_opinions()
-
-    @property
-    def docket_number(self):
-        return self._docket_entry.get('docket_number')
-
-    @property
-    def url(self):
-        abs_url = self._opinion_cluster.get('absolute_url')
-        return COURTLISTENER_BASE_URL + abs_url if abs_url else None
+    @staticmethod
+    def all_stored_sha1s(db_connection):
+        """Returns a dict of docket number => sha1 for every stored
+        case filing.
+        """
+        cur = db_connection.cursor()
+        cur.execute('SELECT docket_number, sha1 FROM case_filings;')
+        return dict(cur)
+
+    @classmethod
+    def stored(cls, docket_number, sha1):
+        """Returns the case filing stored under DOCKET_NUMBER, whose
+        opinion text has SHA1, without its opinions: those are left for
+        set_parsed_opinions(), e.g. to parse the stored text again. Only
+        its docket number and sha1 are set.
+        """
+        case_filing = cls.__new__(cls)
+        case_filing.docket_number = docket_number
+        case_filing.sha1 = sha1
+        case_filing.url = case_filing.filed_on = None
+        case_filing.modified_on = None
+        case_filing.opinions = []
+        case_filing.is_unchanged = True
+        case_filing.needs_parsing = True
+        case_filing._plain_text = None
+        case_filing._text_stored = True
+        return case_filing
 
     @property
     def plain_text(self):
-        return self._opinion.get('plain_text')
-
-    @property
-    def sha1(self):
-        return self._opinion.get('sha1')
-
-    @property
-    def filed_on(self):
-        return self._opinion_cluster.get('date_filed')
+        # Unchanged opinions are not downloaded again, and stored ones
+        # are released, so load the stored copy if it's needed.
+        if self._plain_text is None and self._text_stored:
+            self._plain_text = db.get_plain_text(self.docket_number)
+        return self._plain_text
 
     @property
     def ends_in_letter(self):
@@ -138,20 +330,102 @@ class CaseFiling(_Insertable, _Flagable):
                 plain_text,
                 sha1,
                 filed_on,
+                modified_on,
                 ends_in_letter_flag,
                 no_opinions_flag
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?);
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?);
         """
-        self._insert(db_connection, sql, (
+        # The text itself is stored in `opinion_texts`, under its sha1.
+        inserted = self._insert(db_connection, sql, (
             self.docket_number,
             self.url,
-            self.plain_text,
+            '',
             self.sha1,
             self.filed_on,
+            self.modified_on,
             self.ends_in_letter,
             self.has_no_opinions
         ))
+        if inserted:
+            self._store_plain_text(db_connection)
+        self._flag_if_needed()
+
+    def update(self, db_connection, replace_opinions):
+        """Updates the stored case filing with this one. If
+        REPLACE_OPINIONS, its stored opinion text is replaced as well,
+        and its stored opinions and their concurrences are deleted so
+        that this case filing's opinions can be inserted in their place.
+
+        The opinions of a case filing that a reviewer corrected in the
+        admin interface (one with a `reviewed_on`) are kept, though, and
+        it's flagged instead. Returns whether the opinions were deleted.
+        """
+        sql = """
+            UPDATE case_filings SET
+                url = ?,
+                filed_on = ?,
+                modified_on = ?
+            WHERE docket_number = ?;
+        """
+        utils.log('Updating {}', self)
+        cur = db_connection.cursor()
+        cur.execute(sql, (
+            self.url,
+            self.filed_on,
+            self.modified_on,
+            self.docket_number
+        ))
+        if not replace_opinions:
+            return False
+        cur.execute(
+            'SELECT reviewed_on FROM case_filings WHERE docket_number = ?;',
+            (self.docket_number,)
+        )
+        (reviewed_on,) = cur.fetchone()
+        if reviewed_on is not None:
+            cur.execute(
+                'UPDATE case_filings SET sha1 = ? WHERE docket_number = ?;',
+                (self.sha1, self.docket_number)
+            )
+            self._store_plain_text(db_connection)
+            db.delete_unused_plain_texts(db_connection)
+            self.flag('Opinion text changed since it was reviewed on {}, so '
+                      'its opinions need reviewing again'.format(reviewed_on))
+            return False
+        cur.execute("""
+            UPDATE case_filings SET
+                sha1 = ?,
+                no_opinions_flag = ?
+            WHERE docket_number = ?;
+
+            DELETE FROM concurrences WHERE opinion_id IN (
+                SELECT id FROM opinions WHERE docket_number = ?
+            );
+            DELETE FROM opinions WHERE docket_number = ?;
+        """, (
+            self.sha1,
+            self.has_no_opinions,
+            self.docket_number,
+            self.docket_number,
+            self.docket_number
+        ))
+        self._store_plain_text(db_connection)
+        db.delete_unused_plain_texts(db_connection)
+        self.flag('Opinion text changed, so its opinions were replaced')
+        self._flag_if_needed()
+        return True
+
+    def fetch_stored(self, db_connection):
+        """Returns the (sha1, modified_on) of this case filing as
+        stored in the database, or None if it has not been inserted.
+        """
+        sql = 'SELECT sha1, modified_on FROM case_filings WHERE docket_number = ?;'
+        cur = db_connection.cursor()
+        cur.execute(sql, (self.docket_number,))
+        return cur.fetchone()
+
+    def _flag_if_needed(self):
         if self.ends_in_letter:
             # CaseFilings whose docket numbers end in a letter. Only 'A'
             # and 'M' are known to occur, but others should be flagged
@@ -160,28 +434,23 @@ class CaseFiling(_Insertable, _Flagable):
         if self.has_no_opinions:
             self.flag('Has no opinions')
 
-    def __get(self, endpoint, filter_dict):
-        filtered_endpoint = endpoint + filters_to_url_params(filter_dict)
-        response = self._http_session.get(filtered_endpoint)
-        return get_response_json(response)
-
-    def _fetch_opinion_cluster(self):
-        clusters = self._docket_entry.get('clusters')
-        _assert_unit_list(clusters)
-        self._opinion_cluster = self.__get(clusters[0], OPINION_CLUSTER_FILTERS)
-
-    def _fetch_opinion(self):
-        opinions = self._opinion_cluster.get('sub_opinions')
-        _assert_unit_list(opinions)
-        self._opinion = self.__get(opinions[0], OPINION_INSTANCE_FILTERS)
-
-    def _parse_opinions(self):
-        opinion_tuples = regex.findall_opinions(self.plain_text)
-        if len(opinion_tuples):
-            majority_tuple, secondary_tuples = opinion_tuples[0], opinion_tuples[1:]
-            self.opinions.append(MajorityOpinion(self, *majority_tuple[:3]))
+    def _store_plain_text(self, db_connection):
+        db.store_plain_text(db_connection, self.sha1, self.plain_text)
+        # It's only needed again if parsed again, which is rare.
+        self._plain_text = None
+        self._text_stored = True
+
+    def set_parsed_opinions(self, parsed_opinions):
+        """Sets this case filing's opinions from the result of
+        regex.parse_opinions().
+        """
+        if len(parsed_opinions):
+            majority_tuple, secondary_tuples = parsed_opinions[0], parsed_opinions[1:]
+            author, _, concurring_justices = majority_tuple
+            self.opinions.append(MajorityOpinion(self, author, concurring_justices))
             for tup in secondary_tuples:
-                self.opinions.append(Opinion(self, *tup[3:]))
+                self.opinions.append(Opinion(self, *tup))
+        self.needs_parsing = False
 
     def __str__(self):
         return self.docket_number
@@ -207,6 +476,16 @@ class OpinionType(Enum):
     def __str__(self):
         return self.name.lower().replace('_', ' ')
 
+    @staticmethod
+    def populate(db_connection):
+        """Inserts the opinion types that aren't stored yet."""
+        sql = 'INSERT OR IGNORE INTO opinion_types (type) VALUES (?);'
+        with db_connection:
+            db_connection.cursor().executemany(
+                sql,
+                [(str(op_type),) for op_type in list(OpinionType)]
+            )
+
     # TODO: rename/split
     @staticmethod
     def to_type(val):
@@ -218,15 +497,15 @@ class OpinionType(Enum):
 
 
 class Opinion(_Insertable):
-    def __init__(self, case_filing, authoring_justice, type_, concurring_chief,
-                 concurring_assocs):
+    __slots__ = ('case_filing', 'authoring_justice', 'concurring_justices',
+                 'type', 'effective_type', 'id')
+
+    def __init__(self, case_filing, authoring_justice, type_,
+                 concurring_justices):
         self.case_filing = case_filing
         self.authoring_justice = authoring_justice
-        # Put concurring justices (chief and assoc.) into a list
         # TODO: convert these to Justice objects
-        self.concurring_justices = regex.split_justices(concurring_assocs)
-        if concurring_chief:
-            self.concurring_justices += [concurring_chief]
+        self.concurring_justices = list(concurring_justices)
         # Get the OpinionType enum value
         if isinstance(type_, OpinionType):
             self.type = type_
@@ -239,6 +518,13 @@ class Opinion(_Insertable):
     def has_no_concurrences(self):
         return not len(self.concurring_justices)
 
+    @property
+    def concurring_mask(self):
+        """Returns the bitmask (see Justice) of the recognized
+        concurring justices.
+        """
+        return Justice.mask(self.concurring_justices)
+
     @property
     def needs_effective_type(self):
         return self.type == OpinionType.CONCURRING_AND_DISSENTING \
@@ -278,8 +564,11 @@ class Opinion(_Insertable):
             utils.warn(msg, self.authoring_justice, repr(self))
             return False
         tup = self._sql_tuple + (self.has_no_concurrences, self.needs_effective_type)
-        cur = self._insert(db_connection, sql, tup)
-        self._fetch_id(cur)
+        if self._insert(db_connection, sql, tup):
+            # Cache the ID.
+            self.id = db_connection.last_insert_rowid()
+        else:
+            self._fetch_id(db_connection.cursor())
         return True
 
     def _fetch_id(self, cursor):
@@ -345,9 +634,9 @@ class Opinion(_Insertable):
 
 
 class MajorityOpinion(Opinion):
-    def __init__(self, case_filing, authoring_justice, concurring_chief,
-                 concurring_assocs):
+    __slots__ = ()
+
+    def __init__(self, case_filing, authoring_justice, concurring_justices):
         super(MajorityOpinion, self).__init__(case_filing, authoring_justice,
                                               OpinionType.MAJORITY,
-                                              concurring_chief,
-                                              concurring_assocs)
+                                              concurring_justices)
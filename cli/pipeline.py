@@ -0,0 +1,181 @@
+"""Streaming sync pipeline.
+
+Case filings flow through three stages connected by bounded queues, so
+that at most a few queues' worth of opinions are in memory at a time:
+
+1. fetch: a thread that drains an iterable of unparsed CaseFilings,
+   e.g. from get_active_docket(), which fetches with its own pool of
+   HTTP workers.
+2. parse: a thread that hands each opinion's plain text to a pool of
+   worker processes running regex.parse_opinions().
+3. write: the caller, which iterates over run() and writes the parsed
+   case filings to the database.
+"""
+
+from collections import deque
+import multiprocessing
+from Queue import Empty, Queue
+import sys
+import threading
+from time import time
+import traceback
+
+import metrics
+import regex
+import utils
+
+
+# Maximum number of case filings waiting between two stages, and being
+# parsed at once.
+DEFAULT_QUEUE_SIZE = 64
+
+_DONE = object()
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        # Time spent waiting for the previous stage.
+        self.waiting = 0.0
+        self._started_at = time()
+        self._finished_at = None
+
+    def finish(self):
+        self._finished_at = time()
+
+    def report(self):
+        elapsed = (self._finished_at or time()) - self._started_at
+        utils.log('{} stage: {} case filings in {:.1f}s ({:.1f}/s), {:.1f}s waiting for input',
+                  self.name, self.count, elapsed,
+                  self.count / elapsed if elapsed else 0, self.waiting)
+
+
+def run(case_filings, processes=None, queue_size=DEFAULT_QUEUE_SIZE):
+    """Yields each of CASE_FILINGS, in order, once its opinions have been
+    parsed by a pool of PROCESSES worker processes (one per CPU by
+    default). CASE_FILINGS should have been created with parse=False.
+    """
+    fetched = Queue(queue_size)
+    parsed = Queue(queue_size)
+    fetch_stats = StageStats('Fetch')
+    parse_stats = StageStats('Parse')
+    write_stats = StageStats('Write')
+    errors = []
+    # Set once the write stage is done, early or not, so that the other
+    # stages stop too.
+    stopped = threading.Event()
+
+    def fetch():
+        try:
+            iterator = iter(case_filings)
+            while not stopped.is_set():
+                started_at = time()
+                case_filing = next(iterator, _DONE)
+                fetch_stats.waiting += time() - started_at
+                if case_filing is _DONE:
+                    break
+                fetched.put(case_filing)
+                fetch_stats.count += 1
+        except Exception as e:
+            _fail(errors, 'fetch', e)
+        finally:
+            fetch_stats.finish()
+            fetched.put(_DONE)
+
+    def parse():
+        # Case filings (in order) and their pending parse results.
+        pending = deque()
+
+        def forward_oldest():
+            case_filing, result = pending.popleft()
+            if result is not None:
+                parsed_opinions, seconds = result.get()
+                # Timed by the worker process, whose own metrics are
+                # lost.
+                metrics.record('parse_opinions', seconds)
+                case_filing.set_parsed_opinions(parsed_opinions)
+                parse_stats.count += 1
+            parsed.put(case_filing)
+
+        try:
+            while not stopped.is_set():
+                started_at = time()
+                case_filing = fetched.get()
+                parse_stats.waiting += time() - started_at
+                if case_filing is _DONE:
+                    break
+                result = None
+                if case_filing.needs_parsing:
+                    result = pool.apply_async(_parse_opinions,
+                                              (case_filing.plain_text,))
+                pending.append((case_filing, result))
+                if len(pending) >= queue_size:
+                    forward_oldest()
+            while pending and not stopped.is_set():
+                forward_oldest()
+        except Exception as e:
+            _fail(errors, 'parse', e)
+        finally:
+            parse_stats.finish()
+            parsed.put(_DONE)
+
+    # Start the worker processes before any other thread.
+    pool = multiprocessing.Pool(processes)
+    threads = [threading.Thread(target=fetch), threading.Thread(target=parse)]
+    try:
+        for thread in threads:
+            # Don't keep the process alive if the write stage gives up.
+            thread.daemon = True
+            thread.start()
+        while True:
+            started_at = time()
+            case_filing = parsed.get()
+            write_stats.waiting += time() - started_at
+            if case_filing is _DONE:
+                break
+            yield case_filing
+            write_stats.count += 1
+        write_stats.finish()
+        if errors:
+            raise errors[0]
+    finally:
+        stopped.set()
+        # If the write stage stopped early, the other stages may be
+        # blocked on a full queue. The parse stage is stopped first, as
+        # it is the one taking from `fetched`, and before the pool is
+        # terminated, as it may be waiting on a parse result.
+        _drain(parsed, threads[1])
+        _drain(fetched, threads[0])
+        pool.terminate()
+        for stats in (fetch_stats, parse_stats, write_stats):
+            stats.report()
+
+
+def _parse_opinions(plain_text):
+    """Returns regex.parse_opinions(PLAIN_TEXT) and how long it took.
+    Runs in a worker process.
+    """
+    started_at = time()
+    parsed_opinions = regex.parse_opinions(plain_text)
+    return parsed_opinions, time() - started_at
+
+
+def _drain(queue, thread):
+    """Discards what is put on QUEUE until THREAD is done, so that its
+    blocked put() calls return, and joins it.
+    """
+    if thread.ident is None:
+        # Never started.
+        return
+    while thread.is_alive():
+        try:
+            queue.get(timeout=0.1)
+        except Empty:
+            pass
+    thread.join()
+
+
+def _fail(errors, stage, e):
+    utils.warn('{} stage failed:\n{}', stage, ''.join(traceback.format_exception(*sys.exc_info())))
+    errors.append(e)
@@ -1,3 +1,4 @@
+# encoding=utf8
 """REGEX MODULE
 
 It is recommended to always use OPINION_REGEX with re.findall() or
@@ -26,7 +27,9 @@ Capturing Groups (by index, (*) denotes present but may be empty):
 OPINION_SECONDARY
 """
 
+import hashlib
 import re
+import unicodedata
 
 # Matches and returns the name of a Justice
 _JUSTICE = r'Justice (.+?)'
@@ -56,6 +59,16 @@ DOCKET_NUM = r'\bS\d+[A-Z]?\b'
 _flags = re.IGNORECASE | re.UNICODE
 _compiled_opinion = re.compile(OPINION, flags=_flags)
 
+# Identifies what parse_opinions() returns for a given text, e.g. to
+# cache its results. Changes to OPINION change it by themselves; bump
+# _PARSER_REVISION when changing how the matches are turned into
+# opinions, e.g. split_justices().
+_PARSER_REVISION = 1
+PARSER_VERSION = '{}.{}'.format(
+    _PARSER_REVISION,
+    hashlib.sha1('{}/{}'.format(OPINION, _flags)).hexdigest()[:12]
+)
+
 
 def normalize_whitespace(text):
     """Converts literal newlines ('\' followed by 'n') and whitespace
@@ -69,6 +82,29 @@ def findall_opinions(plain_text, normalize=True):
     return _compiled_opinion.findall(text)
 
 
+def parse_opinions(plain_text):
+    """Returns an (authoring justice, opinion type, concurring justices)
+    tuple for each opinion in PLAIN_TEXT, beginning with the majority
+    opinion, whose type is 'majority'.
+
+    This is a module-level function so that it can be run by worker
+    processes.
+    """
+    opinions = []
+    for i, groups in enumerate(findall_opinions(plain_text)):
+        if i == 0:
+            author, type_, concurring_chief, concurring_assocs = \
+                (groups[0], 'majority') + groups[1:3]
+        else:
+            author, type_, concurring_chief, concurring_assocs = groups[3:]
+        # Put concurring justices (chief and assoc.) into a list
+        concurring_justices = split_justices(concurring_assocs)
+        if concurring_chief:
+            concurring_justices += [concurring_chief]
+        opinions.append((author, type_, concurring_justices))
+    return opinions
+
+
 def split_justices(justices):
     if not justices:
         return []
@@ -81,12 +117,61 @@ def split_justices(justices):
     return retval + [last_justice] if last_justice else retval
 
 
-def findall_and_reduce(needles, haystack):
-    matches = []
-    for needle in needles:
-        haystack = haystack.strip()
-        match = re.search(needle, haystack, flags=_flags)
-        if match:
-            matches.append(match.group())
-            haystack = haystack[:match.start()] + haystack[match.end():]
-    return matches, haystack.strip()
+# Separators left over between names once the names are taken out of a
+# list of names, e.g. ', ' and ' and '.
+_NAME_SEPARATORS = re.compile(r'^(?:[\s,]|\band\b)+|(?:[\s,]|\band\b)+$',
+                              flags=_flags)
+
+
+def fold(text):
+    """Returns TEXT lowercased and without diacritics, e.g. u'Cuéllar'
+    becomes u'cuellar'. Characters are folded one for one, so indices
+    into the result are also indices into TEXT.
+    """
+    if isinstance(text, str):
+        text = text.decode('utf8')
+    return u''.join(_fold_char(c) for c in text)
+
+
+def _fold_char(c):
+    decomposed = unicodedata.normalize('NFKD', c)
+    base = u''.join(d for d in decomposed if not unicodedata.combining(d))
+    return (base or c).lower()[:1] or c
+
+
+class NameMatcher(object):
+    """Finds all occurrences of any of NAMES in a string with a single
+    compiled regex, ignoring case and diacritics. Longer names are
+    matched first, so a name is never taken for a shorter one that it
+    contains.
+    """
+
+    def __init__(self, names):
+        # Folded name => name
+        self._names = {fold(name): name for name in names}
+        alternatives = sorted(self._names, key=len, reverse=True)
+        self._regex = re.compile(
+            u'|'.join(re.escape(name) for name in alternatives) or r'(?!)',
+            flags=re.UNICODE
+        )
+
+    def findall_and_reduce(self, haystack):
+        """Returns a list of the names found in HAYSTACK, in order and
+        without duplicates, and a list of the fragments of HAYSTACK
+        that are left once the names (and the separators between them)
+        are taken out.
+        """
+        if isinstance(haystack, str):
+            haystack = haystack.decode('utf8')
+        matches = []
+        fragments = []
+        end = 0
+        for match in self._regex.finditer(fold(haystack)):
+            name = self._names[match.group()]
+            if name not in matches:
+                matches.append(name)
+            fragments.append(haystack[end:match.start()])
+            end = match.end()
+        fragments.append(haystack[end:])
+        fragments = [_NAME_SEPARATORS.sub('', f) for f in fragments]
+        return matches, [f for f in fragments if f]
@@ -0,0 +1,347 @@
+"""Offline reparse of the stored opinion texts, run by `python -m cli
+reparse` once the parser in regex.py has changed, rather than wiping the
+database and syncing everything again.
+
+The texts are parsed again by a pool of worker processes, and their
+opinions and concurrences compared with the stored ones. The differences
+are listed and, if applied, written without touching what hasn't
+changed, so that e.g. the IDs and effective types of unchanged opinions
+are kept. Case filings that a reviewer corrected in the admin interface
+(those with a `reviewed_on`) are left alone.
+
+Parse results are cached in `parse_results` under the sha1 of the text
+and regex.PARSER_VERSION, so that reparsing again with the same parser
+parses nothing.
+"""
+
+import json
+import multiprocessing
+from time import time
+
+import apsw
+
+import db
+from .ingest import DEFAULT_BATCH_SIZE
+import metrics
+from .models import CaseFiling, Justice, OpinionType
+import regex
+import utils
+
+
+# Values bound per `IN (...)` list, below SQLite's default limit of 999
+# variables per statement.
+_IN_LIST_SIZE = 500
+
+
+def run(apply=False, processes=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Reparses the stored case filings that haven't been reviewed, in
+    batches of BATCH_SIZE parsed by PROCESSES worker processes (one per
+    CPU by default), and lists how their opinions differ from the stored
+    ones. If APPLY, the differences are written as well, in a
+    transaction per batch.
+    """
+    db_connection = db.connection()
+    Justice.load(db_connection)
+    _prune_parse_results(db_connection)
+    cur = db_connection.cursor()
+    cur.execute("""
+        SELECT COUNT(*) FROM case_filings WHERE reviewed_on IS NOT NULL;
+    """)
+    (reviewed_count,) = cur.fetchone()
+    cur.execute("""
+        SELECT docket_number, sha1
+        FROM case_filings
+        WHERE reviewed_on IS NULL
+        ORDER BY docket_number;
+    """)
+    case_filings = cur.fetchall()
+
+    diff_count = added_count = removed_count = changed_count = 0
+    without_text_count = 0
+    # Start the worker processes before any other thread.
+    pool = multiprocessing.Pool(processes)
+    try:
+        for start in range(0, len(case_filings), batch_size):
+            batch = case_filings[start:start + batch_size]
+            with metrics.span('reparse_batch'):
+                parse_results = _parse(db_connection, pool,
+                                       {sha1 for _, sha1 in batch})
+                stored = _stored_opinions(db_connection,
+                                          [docket for docket, _ in batch])
+                diffs = []
+                for docket_number, sha1 in batch:
+                    if sha1 not in parse_results:
+                        without_text_count += 1
+                        continue
+                    case_filing = CaseFiling.stored(docket_number, sha1)
+                    case_filing.set_parsed_opinions(parse_results[sha1])
+                    diff = OpinionDiff(case_filing,
+                                       stored.get(docket_number, {}))
+                    if diff:
+                        diff.report()
+                        diffs.append(diff)
+                if apply and diffs:
+                    with db_connection:
+                        diffs = [diff for diff in diffs
+                                 if diff.apply(db_connection)]
+            diff_count += len(diffs)
+            added_count += sum(len(diff.added) for diff in diffs)
+            removed_count += sum(len(diff.removed) for diff in diffs)
+            changed_count += sum(len(diff.changed) for diff in diffs)
+    finally:
+        pool.terminate()
+
+    utils.log('{} of {} case filings {}: {} opinions added, {} removed and '
+              '{} with other concurrences', diff_count, len(case_filings),
+              'changed' if apply else 'would change', added_count,
+              removed_count, changed_count)
+    if reviewed_count:
+        utils.log('Left {} case filings corrected by reviewers alone',
+                  reviewed_count)
+    if without_text_count:
+        utils.warn('{} case filings have no stored text', without_text_count)
+
+
+class OpinionDiff(object):
+    """How the opinions parsed from a case filing's text differ from
+    its stored ones: the opinions to add, the stored ones to remove, and
+    the stored ones whose concurring justices differ.
+    """
+
+    def __init__(self, case_filing, stored_opinions):
+        """CASE_FILING holds the parsed opinions, and STORED_OPINIONS is
+        as returned by _stored_opinions() for it.
+        """
+        self.case_filing = case_filing
+        # [(Opinion, concurring shorthands)]
+        self.added = []
+        # [(opinion ID, type ID, authoring shorthand)]
+        self.removed = []
+        # [(opinion ID, type ID, authoring shorthand, concurring
+        # shorthands to add, concurring shorthands to remove, whether it
+        # has concurrences)]
+        self.changed = []
+
+        parsed_keys = set()
+        for opinion in case_filing.opinions:
+            author = Justice.get(opinion.authoring_justice)
+            if author is None:
+                utils.warn("Unknown authoring justice '{}' in {}",
+                           opinion.authoring_justice, repr(opinion))
+                continue
+            key = (opinion.type.value, author.shorthand)
+            if key in parsed_keys:
+                # Only the first would be inserted.
+                continue
+            parsed_keys.add(key)
+            justices, unknown_names = \
+                Justice.resolve(opinion.concurring_justices)
+            for name in unknown_names:
+                utils.warn("Unknown concurring justice '{}' in {}", name,
+                           repr(opinion))
+            concurring = {justice.shorthand for justice in justices}
+            if key not in stored_opinions:
+                self.added.append((opinion, concurring))
+                continue
+            opinion_id, stored_concurring = stored_opinions[key]
+            if concurring != stored_concurring:
+                self.changed.append((
+                    opinion_id, key[0], key[1],
+                    concurring - stored_concurring,
+                    stored_concurring - concurring,
+                    bool(concurring)
+                ))
+        for key, (opinion_id, _) in sorted(stored_opinions.iteritems()):
+            if key not in parsed_keys:
+                self.removed.append((opinion_id,) + key)
+
+    def __nonzero__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def report(self):
+        utils.log('{}:', self.case_filing)
+        for opinion, concurring in self.added:
+            utils.log('  + {}{}', _describe(
+                opinion.type.value,
+                Justice.get(opinion.authoring_justice).shorthand
+            ), _joined_by(concurring))
+        for opinion_id, type_id, author in self.removed:
+            utils.log('  - {} (#{})', _describe(type_id, author),
+                      opinion_id)
+        for opinion_id, type_id, author, to_add, to_remove, _ in self.changed:
+            utils.log('  ~ {} (#{}): {}', _describe(type_id, author),
+                      opinion_id, ' '.join(
+                          ['+' + j for j in sorted(to_add)]
+                          + ['-' + j for j in sorted(to_remove)]
+                      ))
+
+    def apply(self, db_connection):
+        """Writes the differences to the database in a savepoint of its
+        own, and returns whether it succeeded.
+        """
+        insert_concurrence_sql = """
+            INSERT INTO concurrences (
+                opinion_id,
+                justice
+            )
+            VALUES (?, ?);
+        """
+        delete_concurrence_sql = """
+            DELETE FROM concurrences WHERE opinion_id = ? AND justice = ?;
+        """
+        docket_number = self.case_filing.docket_number
+        try:
+            with db_connection:
+                cur = db_connection.cursor()
+                for opinion_id, _, _ in self.removed:
+                    utils.log('Deleting opinion #{} of {}', opinion_id,
+                              docket_number)
+                    cur.execute("""
+                        DELETE FROM concurrences WHERE opinion_id = ?;
+                        DELETE FROM opinions WHERE id = ?;
+                    """, (opinion_id, opinion_id))
+                concurrences = []
+                for opinion, concurring in self.added:
+                    opinion.insert(db_connection)
+                    concurrences.extend((opinion.id, justice)
+                                        for justice in sorted(concurring))
+                deleted_concurrences = []
+                for opinion_id, _, _, to_add, to_remove, has_concurrences \
+                        in self.changed:
+                    concurrences.extend((opinion_id, justice)
+                                        for justice in sorted(to_add))
+                    deleted_concurrences.extend((opinion_id, justice)
+                                                for justice in to_remove)
+                    cur.execute("""
+                        UPDATE opinions SET no_concurrences_flag = ?
+                        WHERE id = ?;
+                    """, (not has_concurrences, opinion_id))
+                if deleted_concurrences:
+                    cur.executemany(delete_concurrence_sql,
+                                    deleted_concurrences)
+                if concurrences:
+                    cur.executemany(insert_concurrence_sql, concurrences)
+                cur.execute("""
+                    UPDATE case_filings SET no_opinions_flag = ?
+                    WHERE docket_number = ?;
+                """, (self.case_filing.has_no_opinions, docket_number))
+        except apsw.Error as e:
+            utils.warn('Unable to reparse {}: {}', docket_number, e)
+            metrics.increment('case_filings_failed')
+            return False
+        metrics.increment('case_filings_reparsed')
+        return True
+
+
+def _describe(type_id, author):
+    return '{} opinion by {}'.format(str(OpinionType(type_id)).upper(),
+                                     author)
+
+
+def _joined_by(concurring):
+    if not concurring:
+        return ''
+    return ', joined by ' + ', '.join(sorted(concurring))
+
+
+def _parse(db_connection, pool, sha1s):
+    """Returns a dict of sha1 => regex.parse_opinions() of the stored
+    text, for each of SHA1S whose text is stored. Results are taken from
+    `parse_results` where possible, and the others parsed by POOL and
+    cached there.
+    """
+    sha1s = list(sha1s)
+    cur = db_connection.cursor()
+    results = {}
+    for chunk in _chunks(sha1s):
+        cur.execute("""
+            SELECT sha1, opinions
+            FROM parse_results
+            WHERE parser_version = ? AND sha1 IN ({});
+        """.format(_placeholders(chunk)), [regex.PARSER_VERSION] + chunk)
+        results.update((sha1, json.loads(opinions)) for sha1, opinions in cur)
+    metrics.increment('parse_cache_hits', len(results))
+
+    missing = [sha1 for sha1 in sha1s if sha1 not in results]
+    if not missing:
+        return results
+    texts = []
+    for chunk in _chunks(missing):
+        cur.execute("""
+            SELECT sha1, plain_text FROM opinion_texts WHERE sha1 IN ({});
+        """.format(_placeholders(chunk)), chunk)
+        # Blobs can't be pickled, and are decompressed by the workers.
+        texts.extend((sha1, str(plain_text)) for sha1, plain_text in cur)
+    parsed = pool.map(_parse_stored_text, [text for _, text in texts])
+    for (sha1, _), (parsed_opinions, seconds) in zip(texts, parsed):
+        # Timed by the worker process, whose own metrics are lost.
+        metrics.record('parse_opinions', seconds)
+        results[sha1] = parsed_opinions
+    metrics.increment('parse_cache_misses', len(texts))
+    if texts:
+        with db_connection:
+            cur.executemany("""
+                INSERT OR REPLACE INTO parse_results (
+                    sha1,
+                    parser_version,
+                    opinions
+                )
+                VALUES (?, ?, ?);
+            """, [(sha1, regex.PARSER_VERSION, json.dumps(results[sha1]))
+                  for sha1, _ in texts])
+    return results
+
+
+def _parse_stored_text(compressed_text):
+    """Returns regex.parse_opinions() of the text compressed into
+    COMPRESSED_TEXT, and how long it took. Runs in a worker process.
+    """
+    started_at = time()
+    parsed_opinions = regex.parse_opinions(db.decompress_text(compressed_text))
+    return parsed_opinions, time() - started_at
+
+
+def _stored_opinions(db_connection, docket_numbers):
+    """Returns a dict of docket number => {(type ID, authoring
+    shorthand) => (opinion ID, set of concurring shorthands)} for each
+    of DOCKET_NUMBERS that has stored opinions, with a query per
+    _IN_LIST_SIZE of them.
+    """
+    cur = db_connection.cursor()
+    stored = {}
+    for chunk in _chunks(docket_numbers):
+        cur.execute("""
+            SELECT o.docket_number, o.id, o.type_id, o.authoring_justice,
+                   c.justice
+            FROM opinions o
+            LEFT JOIN concurrences c ON c.opinion_id = o.id
+            WHERE o.docket_number IN ({});
+        """.format(_placeholders(chunk)), chunk)
+        for docket_number, opinion_id, type_id, author, justice in cur:
+            opinions = stored.setdefault(docket_number, {})
+            _, concurring = opinions.setdefault((type_id, author),
+                                                (opinion_id, set()))
+            if justice is not None:
+                concurring.add(justice)
+    return stored
+
+
+def _prune_parse_results(db_connection):
+    """Deletes the cached parse results of other versions of the parser,
+    and of texts that are no longer stored.
+    """
+    with db_connection:
+        db_connection.cursor().execute("""
+            DELETE FROM parse_results
+            WHERE parser_version != ?
+                OR sha1 NOT IN (SELECT sha1 FROM opinion_texts);
+        """, (regex.PARSER_VERSION,))
+
+
+def _placeholders(values):
+    return ', '.join('?' * len(values))
+
+
+def _chunks(values):
+    for start in range(0, len(values), _IN_LIST_SIZE):
+        yield values[start:start + _IN_LIST_SIZE]
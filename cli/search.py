@@ -0,0 +1,105 @@
+"""Full-text search over the stored opinion texts, run by `python -m cli
+search` and served at /api/search.
+
+The texts are indexed with FTS5 in `opinion_search` (see migration 005),
+which takes FTS5 queries: words, "phrases", prefix*, AND/OR/NOT and
+NEAR(). The index doesn't keep the texts, so the snippet of each match
+is made from its stored text, which is only decompressed for the
+matches returned.
+"""
+
+import re
+
+import apsw
+
+import db
+
+
+DEFAULT_LIMIT = 20
+# Characters of context on each side of the first match in a snippet.
+SNIPPET_CONTEXT = 80
+# Marks around each matching word in a snippet.
+SNIPPET_MARKS = ('[', ']')
+
+_OPERATORS = frozenset(['AND', 'OR', 'NOT', 'NEAR'])
+
+
+def search(db_connection, query, limit=DEFAULT_LIMIT):
+    """Returns up to LIMIT case filings whose opinion text matches the
+    FTS5 QUERY, best match first, as dicts of docket_number, filed_on,
+    rank (lower is better) and snippet. Raises ValueError if QUERY is
+    not a valid FTS5 query.
+    """
+    # Each text may be shared by several case filings, so up to LIMIT
+    # texts are enough for LIMIT case filings.
+    sql = """
+        SELECT
+            case_filings.docket_number,
+            case_filings.filed_on,
+            matches.rank,
+            opinion_texts.plain_text
+        FROM (
+            SELECT rowid, rank
+            FROM opinion_search
+            WHERE opinion_search MATCH ?
+            ORDER BY rank
+            LIMIT ?
+        ) matches
+        JOIN opinion_search_texts ON opinion_search_texts.id = matches.rowid
+        JOIN case_filings ON case_filings.sha1 = opinion_search_texts.sha1
+        JOIN opinion_texts ON opinion_texts.sha1 = opinion_search_texts.sha1
+        ORDER BY matches.rank, case_filings.filed_on DESC,
+                 case_filings.docket_number
+        LIMIT ?;
+    """
+    cur = db_connection.cursor()
+    try:
+        rows = cur.execute(sql, (query, limit, limit)).fetchall()
+    except apsw.SQLError as e:
+        # The statement is fixed, so only the query can be at fault, e.g.
+        # "SQLError: fts5: syntax error near ..."
+        raise ValueError('Invalid search query: {}'.format(
+            str(e).split(': ', 1)[-1]
+        ))
+    pattern = _terms_pattern(query)
+    return [{
+        'docket_number': docket_number,
+        'filed_on': filed_on,
+        'rank': rank,
+        'snippet': snippet(db.decompress_text(plain_text), pattern),
+    } for docket_number, filed_on, rank, plain_text in rows]
+
+
+def snippet(text, pattern):
+    """Returns the part of TEXT around the first match of PATTERN (as
+    from _terms_pattern()), on one line and with each match marked, or
+    the start of TEXT if nothing matches.
+    """
+    match = pattern.search(text) if pattern is not None else None
+    start = max(match.start() - SNIPPET_CONTEXT, 0) if match else 0
+    end = (match.end() if match else 0) + SNIPPET_CONTEXT
+    excerpt = ' '.join(text[start:end].split())
+    if pattern is not None:
+        excerpt = pattern.sub(
+            lambda m: SNIPPET_MARKS[0] + m.group(0) + SNIPPET_MARKS[1],
+            excerpt
+        )
+    return (('...' if start > 0 else '') + excerpt
+            + ('...' if end < len(text) else ''))
+
+
+def _terms_pattern(query):
+    """Returns a regex matching the words that QUERY searches for, or
+    None if it has none.
+    """
+    terms = set()
+    for word, prefix in re.findall(r'(\w+)(\*?)', query, re.UNICODE):
+        if word not in _OPERATORS:
+            terms.add(re.escape(word) + (r'\w*' if prefix else r'\b'))
+    if not terms:
+        return None
+    # Longest first, so that the longest of overlapping terms is marked.
+    return re.compile(
+        r'\b(?:' + '|'.join(sorted(terms, key=len, reverse=True)) + ')',
+        re.IGNORECASE | re.UNICODE
+    )
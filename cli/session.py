@@ -0,0 +1,198 @@
+"""Cached, rate-limited HTTP session for the CourtListener API."""
+
+from calendar import timegm
+from email.utils import formatdate, parsedate
+import os
+import random
+import threading
+import time
+
+from cachecontrol import CacheControlAdapter
+from cachecontrol.heuristics import BaseHeuristic
+import requests
+from requests.adapters import HTTPAdapter
+
+from .cache import SQLiteCache
+import date
+from .http import COURTLISTENER_BASE_URL, get_requests_header
+import metrics
+import utils
+
+
+# CourtListener allows 5,000 API requests per hour per token. A run
+# spends at most API_REQUEST_BUDGET of those per hour, leaving some
+# headroom for other users of the token, and may burst up to
+# API_REQUEST_BURST requests before being held to that rate. The budget
+# can be overridden by the COURTLISTENER_REQUEST_BUDGET environment
+# variable, e.g. for a local stub server.
+API_REQUEST_QUOTA = 5000
+API_REQUEST_BUDGET = int(os.environ.get('COURTLISTENER_REQUEST_BUDGET')
+                         or API_REQUEST_QUOTA * 9 // 10)
+API_REQUEST_BURST = 50
+# Responses with these status codes are retried up to MAX_RETRIES times,
+# waiting RETRY_BACKOFF_BASE * 2^n seconds (with full jitter, at most
+# RETRY_BACKOFF_MAX) unless the response sets Retry-After.
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+MAX_RETRIES = 5
+RETRY_BACKOFF_BASE = 1.0
+RETRY_BACKOFF_MAX = 120.0
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket that allows bursts of up to CAPACITY
+    requests and RATE requests per second thereafter.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.requests_sent = 0
+        self._tokens = self.capacity
+        self._updated_at = time.time()
+        # No tokens are handed out before this time (see defer()).
+        self._not_before = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        with self._lock:
+            now = time.time()
+            elapsed = now - self._updated_at
+            self._tokens = min(self.capacity,
+                               self._tokens + elapsed * self.rate)
+            self._updated_at = now
+            # Take the token now, even if it sends the bucket into debt,
+            # so that waiting threads are served in order.
+            self._tokens -= 1
+            wait = max(-self._tokens / self.rate, self._not_before - now, 0)
+            self.requests_sent += 1
+        if wait:
+            time.sleep(wait)
+
+    def defer(self, seconds):
+        """Holds every request for at least SECONDS from now, e.g. when
+        the API responds with Retry-After.
+        """
+        with self._lock:
+            self._not_before = max(self._not_before, time.time() + seconds)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """Transport adapter that takes a token from RATE_LIMITER before
+    each request that goes over the network and retries responses in
+    RETRY_STATUS_CODES.
+    """
+
+    def __init__(self, rate_limiter=None, *args, **kw):
+        super(RateLimitedAdapter, self).__init__(*args, **kw)
+        self.rate_limiter = rate_limiter or default_rate_limiter()
+
+    def send(self, request, **kw):
+        for attempt in range(MAX_RETRIES + 1):
+            self.rate_limiter.acquire()
+            metrics.increment('http_requests')
+            response = super(RateLimitedAdapter, self).send(request, **kw)
+            if response.status_code not in RETRY_STATUS_CODES \
+                    or attempt == MAX_RETRIES:
+                break
+            delay = _retry_after(response)
+            if delay is None:
+                delay = random.uniform(0, min(RETRY_BACKOFF_MAX,
+                                              RETRY_BACKOFF_BASE * 2 ** attempt))
+            utils.warn('{} from {}; retrying in {:.1f}s ({}/{})',
+                       response.status_code, request.url, delay,
+                       attempt + 1, MAX_RETRIES)
+            metrics.increment('http_retries')
+            if response.status_code == 429:
+                # The quota applies to every thread, not just this one.
+                self.rate_limiter.defer(delay)
+            response.close()
+            time.sleep(delay)
+        return response
+
+
+class CachedRateLimitedAdapter(CacheControlAdapter, RateLimitedAdapter):
+    """CacheControlAdapter whose cache misses and revalidations go
+    through RateLimitedAdapter. Responses served from the cache cost no
+    tokens.
+    """
+
+    def __init__(self, *args, **kw):
+        super(CachedRateLimitedAdapter, self).__init__(*args, **kw)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Bytes of responses served from the cache instead of the API.
+        self.bytes_saved = 0
+        self._stats_lock = threading.Lock()
+
+    def send(self, request, **kw):
+        response = super(CachedRateLimitedAdapter, self).send(request, **kw)
+        with self._stats_lock:
+            if response.from_cache:
+                self.cache_hits += 1
+                self.bytes_saved += len(response.content)
+            else:
+                self.cache_misses += 1
+        metrics.increment('http_cache_hits' if response.from_cache
+                          else 'http_cache_misses')
+        return response
+
+
+class CacheHeuristic(BaseHeuristic):
+    def update_headers(self, response):
+        response_date = parsedate(response.headers['date'])
+        return {
+            'expires': formatdate(date.response_expiry(response_date)),
+            'cache-control': 'public',
+        }
+
+    def warning(self, response):
+        return '110 - "automatically cached, response is stale"'
+
+
+def _retry_after(response):
+    """Returns the number of seconds to wait according to RESPONSE's
+    Retry-After header, or None if it isn't set.
+    """
+    value = response.headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        retry_date = parsedate(value)
+        if retry_date is None:
+            return None
+        return max(timegm(retry_date) - time.time(), 0)
+
+
+def default_rate_limiter():
+    return TokenBucket(API_REQUEST_BUDGET / 3600.0, API_REQUEST_BURST)
+
+
+def start_http_session(rate_limiter=None, cache=None):
+    """Starts the cached, rate-limited HTTP Session. CACHE may be any
+    CacheControl cache, and defaults to a SQLiteCache.
+    """
+    # Cache file will be created if it doesn't exist.
+    cache = cache or SQLiteCache()
+    adapter = CachedRateLimitedAdapter(cache=cache,
+                                       heuristic=CacheHeuristic(),
+                                       rate_limiter=rate_limiter)
+    http_session = requests.Session()
+    http_session.mount('http://', adapter)
+    http_session.mount('https://', adapter)
+    http_session.headers = get_requests_header()
+    return http_session
+
+
+def close_http_session(http_session):
+    adapter = http_session.get_adapter(COURTLISTENER_BASE_URL)
+    utils.log('Sent {} API requests', adapter.rate_limiter.requests_sent)
+    utils.log('HTTP cache: {} hits, {} misses, {:.1f} MB saved',
+              adapter.cache_hits, adapter.cache_misses,
+              adapter.bytes_saved / 1e6)
+    if isinstance(adapter.cache, SQLiteCache):
+        adapter.cache.report()
+    # Also closes the cache.
+    http_session.close()
@@ -0,0 +1,160 @@
+"""Local stub of the parts of the CourtListener API that the sync uses,
+serving a corpus.Corpus. Point the sync at it by setting the
+COURTLISTENER_BASE_URL environment variable to its base_url.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from email.utils import formatdate
+import json
+import re
+from SocketServer import ThreadingMixIn
+import threading
+import urlparse
+
+
+# Objects per page of a list, as in the API.
+PAGE_SIZE = 20
+
+_ROUTES = (
+    ('dockets', re.compile(r'^/api/rest/v3/dockets/$')),
+    ('opinion_clusters', re.compile(r'^/api/rest/v3/clusters/$')),
+    ('opinion_cluster', re.compile(r'^/api/rest/v3/clusters/(\d+)/$')),
+    ('opinions', re.compile(r'^/api/rest/v3/opinions/$')),
+    ('opinion', re.compile(r'^/api/rest/v3/opinions/(\d+)/$')),
+)
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, corpus, port=0):
+        """Serves CORPUS on PORT of localhost, or any free port if 0."""
+        HTTPServer.__init__(self, ('127.0.0.1', port), _StubRequestHandler)
+        self.corpus = corpus
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.requests_served = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Serves requests in a background thread until shutdown()."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class _StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Buffer each response so that it is sent in one go, rather than a
+    # packet per header held back by Nagle's algorithm.
+    wbufsize = -1
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        query = urlparse.parse_qs(url.query)
+        with self.server._lock:
+            self.server.requests_served += 1
+        for name, route in _ROUTES:
+            match = route.match(url.path)
+            if match:
+                body = getattr(self, '_' + name)(query, *match.groups())
+                break
+        else:
+            body = None
+        if body is None:
+            self._respond(404, {'detail': 'Not found.'})
+        else:
+            self._respond(200, body)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dockets(self, query):
+        corpus = self.server.corpus
+        return self._list('dockets', query, corpus.case_filings,
+                          lambda cf: corpus.docket_entry(cf,
+                                                         self.server.base_url))
+
+    def _opinion_clusters(self, query):
+        corpus = self.server.corpus
+        return self._list('clusters', query, _filter_ids(corpus, query),
+                          lambda cf: corpus.opinion_cluster(
+                              cf, self.server.base_url
+                          ))
+
+    def _opinions(self, query):
+        corpus = self.server.corpus
+        return self._list('opinions', query, _filter_ids(corpus, query),
+                          corpus.opinion)
+
+    def _list(self, endpoint, query, case_filings, to_object):
+        """Returns the page of the list ENDPOINT given by QUERY, of the
+        objects TO_OBJECT returns for CASE_FILINGS.
+        """
+        page = int(query.get('page', ['1'])[0])
+        start = (page - 1) * PAGE_SIZE
+        results = [_select_fields(to_object(case_filing), query)
+                   for case_filing in case_filings[start:start + PAGE_SIZE]]
+        next_page = None
+        if start + PAGE_SIZE < len(case_filings):
+            query = dict(query, page=[str(page + 1)])
+            next_page = '{}/api/rest/v3/{}/?{}'.format(
+                self.server.base_url, endpoint, _encode_query(query)
+            )
+        return {
+            'count': len(case_filings),
+            'next': next_page,
+            'previous': None,
+            'results': results,
+        }
+
+    def _opinion_cluster(self, query, id_):
+        case_filing = self.server.corpus.get(int(id_))
+        if case_filing is None:
+            return None
+        return _select_fields(
+            self.server.corpus.opinion_cluster(case_filing,
+                                               self.server.base_url),
+            query
+        )
+
+    def _opinion(self, query, id_):
+        case_filing = self.server.corpus.get(int(id_))
+        if case_filing is None:
+            return None
+        return _select_fields(self.server.corpus.opinion(case_filing), query)
+
+    def _respond(self, status, body):
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Date', formatdate(usegmt=True))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def _filter_ids(corpus, query):
+    """Returns the case filings of CORPUS whose IDs are listed by the
+    `id__in` parameter of QUERY, or all of them if there is none.
+    """
+    if 'id__in' not in query:
+        return corpus.case_filings
+    ids = ','.join(query['id__in']).split(',')
+    return [case_filing for case_filing in map(corpus.get, map(int, ids))
+            if case_filing is not None]
+
+
+def _select_fields(obj, query):
+    """Returns only the fields of OBJ listed by the `fields` parameter
+    of QUERY, if any, like the API's field selection.
+    """
+    if 'fields' not in query:
+        return obj
+    fields = set(','.join(query['fields']).split(','))
+    return {k: v for k, v in obj.iteritems() if k in fields}
+
+
+def _encode_query(query):
+    return '&'.join('{}={}'.format(k, ','.join(v))
+                    for k, v in sorted(query.iteritems()))
@@ -0,0 +1,203 @@
+"""Syncs the case filings of the active docket from CourtListener into
+the database.
+"""
+
+from collections import deque
+from itertools import takewhile
+from multiprocessing.pool import ThreadPool
+
+import db
+from .http import (
+    DEFAULT_CONCURRENCY, DOCKET_LIST_ENDPOINT, DOCKET_LIST_FILTERS,
+    OPINION_CLUSTER_FILTERS, OPINION_CLUSTER_LIST_ENDPOINT,
+    OPINION_INSTANCE_FILTERS, OPINION_LIST_ENDPOINT, OPINION_TEXT_FILTERS,
+    filters_to_url_params, get_all_results, get_response_json, url_id
+)
+from .ingest import DEFAULT_BATCH_SIZE, BatchWriter
+import metrics
+from .models import CaseFiling, Justice
+import pipeline
+from .session import close_http_session, start_http_session
+import utils
+
+
+# Plain texts fetched per request. A response is held in memory whole,
+# and several times over while it's decoded, so the texts (of up to a
+# few hundred KB each) are fetched a few at a time.
+TEXT_BATCH_SIZE = 5
+
+
+def run(concurrency=DEFAULT_CONCURRENCY, batch_size=DEFAULT_BATCH_SIZE,
+        processes=None):
+    http_session = start_http_session()
+    try:
+        db_connection = db.connection()
+        Justice.load(db_connection)
+        sync_changes(http_session, db_connection, concurrency, batch_size,
+                     processes)
+        db.report_text_storage(db_connection)
+    finally:
+        close_http_session(http_session)
+
+
+def sync_changes(http_session, db_connection,
+                 concurrency=DEFAULT_CONCURRENCY,
+                 batch_size=DEFAULT_BATCH_SIZE, processes=None):
+    """Syncs the entries of the active docket modified since the last
+    sync, and returns the filing dates of their case filings. The
+    justices should be loaded already.
+    """
+    # Dockets are listed most recently modified first, so the listing
+    # can stop at the last one seen by the previous sync.
+    watermark = db.get_sync_state(db_connection, db.SYNC_WATERMARK)
+    filed_on_dates = []
+    stored_sha1s = CaseFiling.all_stored_sha1s(db_connection)
+    case_filings = get_active_docket(http_session, concurrency,
+                                     modified_after=watermark,
+                                     stored_sha1s=stored_sha1s,
+                                     parse=False)
+    with BatchWriter(db_connection, batch_size) as writer:
+        for case_filing in pipeline.run(case_filings, processes):
+            writer.add(case_filing)
+            filed_on_dates.append(case_filing.filed_on)
+    # Only advance the watermark once the whole listing has been
+    # synced, and not past case filings that failed to be written;
+    # otherwise, the next sync would skip them.
+    if writer.failed:
+        utils.warn('Unable to write {} case filings, to be synced again: {}',
+                   len(writer.failed), ', '.join(writer.failed))
+    latest_modified = writer.watermark(watermark)
+    if latest_modified != watermark:
+        db.set_sync_state(db_connection, db.SYNC_WATERMARK, latest_modified)
+    return filed_on_dates
+
+
+def get_active_docket(http_session, concurrency=DEFAULT_CONCURRENCY,
+                      modified_after=None, stored_sha1s=None, parse=True):
+    """Yields a CaseFiling for each entry of the active docket, in the
+    order the API lists them. If MODIFIED_AFTER is given, the listing
+    stops at the first entry last modified at or before it.
+    STORED_SHA1S and PARSE are as for fetch_case_filings().
+
+    The case filings of each page are fetched by fetch_case_filings()
+    in a pool of CONCURRENCY worker threads, with up to CONCURRENCY
+    pages in flight while earlier ones are being yielded.
+    """
+
+    def fetch_page(url):
+        utils.log('Fetching {}', url)
+        with metrics.span('docket_page'):
+            return get_response_json(http_session.get(url))
+
+    def fetch_page_case_filings(docket_entries):
+        with metrics.span('fetch_case_filings'):
+            return fetch_case_filings(http_session, docket_entries,
+                                      stored_sha1s, parse)
+
+    def is_new(docket_entry):
+        return modified_after is None \
+               or docket_entry['date_modified'] > modified_after
+
+    utils.log('Fetching active docket...')
+    pool = ThreadPool(concurrency)
+    try:
+        first_page = DOCKET_LIST_ENDPOINT \
+                     + filters_to_url_params(DOCKET_LIST_FILTERS)
+        pending_page = pool.apply_async(fetch_page, (first_page,))
+        # Case filings of the pages listed so far, in listing order.
+        pending_case_filings = deque()
+        while pending_page is not None or pending_case_filings:
+            if pending_page is None \
+                    or len(pending_case_filings) >= concurrency:
+                for case_filing in pending_case_filings.popleft().get():
+                    yield case_filing
+                continue
+            response = pending_page.get()
+            docket_entries = list(takewhile(is_new, response['results']))
+            next_page = response.get('next')
+            # Queue the next page before this page's case filings so
+            # that it is ready by the time they have all been yielded.
+            if next_page and len(docket_entries) == len(response['results']):
+                pending_page = pool.apply_async(fetch_page, (next_page,))
+            else:
+                pending_page = None
+            if docket_entries:
+                pending_case_filings.append(pool.apply_async(
+                    fetch_page_case_filings, (docket_entries,)
+                ))
+    finally:
+        pool.terminate()
+
+
+def fetch_case_filings(http_session, docket_entries, stored_sha1s=None,
+                       parse=True):
+    """Returns a CaseFiling for each of DOCKET_ENTRIES, fetching their
+    opinion clusters and their opinions' metadata with one list request
+    each, and then the plain texts of the opinions that changed
+    TEXT_BATCH_SIZE at a time, rather than a few requests per docket
+    entry. STORED_SHA1S maps docket numbers to the sha1 of their stored
+    opinion, whose text is then not downloaded again if unchanged. PARSE
+    is passed on to CaseFiling.
+
+    A docket entry whose opinion cluster or opinion is missing from the
+    lists, or which doesn't have exactly one of them, is left to
+    CaseFiling to fetch on its own.
+    """
+    stored_sha1s = stored_sha1s or {}
+
+    def only_id(urls):
+        return url_id(urls[0]) if urls and len(urls) == 1 else None
+
+    cluster_ids = [only_id(docket_entry.get('clusters'))
+                   for docket_entry in docket_entries]
+    clusters = _get_by_id(http_session, OPINION_CLUSTER_LIST_ENDPOINT,
+                          OPINION_CLUSTER_FILTERS, cluster_ids)
+    opinion_ids = [only_id(clusters[cluster_id].get('sub_opinions'))
+                   if cluster_id in clusters else None
+                   for cluster_id in cluster_ids]
+    opinions = _get_by_id(http_session, OPINION_LIST_ENDPOINT,
+                          OPINION_INSTANCE_FILTERS, opinion_ids)
+    changed_opinion_ids = [
+        opinion_id for docket_entry, opinion_id
+        in zip(docket_entries, opinion_ids)
+        if opinion_id in opinions and opinions[opinion_id].get('sha1')
+        != stored_sha1s.get(docket_entry.get('docket_number'))
+    ]
+    texts = {}
+    for i in range(0, len(changed_opinion_ids), TEXT_BATCH_SIZE):
+        batch = _get_by_id(http_session, OPINION_LIST_ENDPOINT,
+                           OPINION_TEXT_FILTERS,
+                           changed_opinion_ids[i:i + TEXT_BATCH_SIZE])
+        texts.update((opinion_id, opinion_text.get('plain_text'))
+                     for opinion_id, opinion_text in batch.iteritems())
+
+    case_filings = []
+    for docket_entry, cluster_id, opinion_id \
+            in zip(docket_entries, cluster_ids, opinion_ids):
+        stored_sha1 = stored_sha1s.get(docket_entry.get('docket_number'))
+        opinion = opinions.get(opinion_id)
+        if opinion is not None and opinion_id in texts:
+            # Popped so that each text is only referenced by its case
+            # filing, which releases it once stored.
+            opinion = dict(opinion, plain_text=texts.pop(opinion_id))
+        elif opinion is not None and opinion.get('sha1') != stored_sha1:
+            # Its text is missing, so leave it all to CaseFiling.
+            opinion = None
+        case_filings.append(CaseFiling(
+            docket_entry, http_session, stored_sha1, parse,
+            opinion_cluster=clusters.get(cluster_id), opinion=opinion
+        ))
+    return case_filings
+
+
+def _get_by_id(http_session, endpoint, filter_dict, ids):
+    """Returns a dict of ID => object of the objects of the list
+    ENDPOINT, filtered by FILTER_DICT, whose IDs are among IDS (strings,
+    or None to skip).
+    """
+    ids = sorted({id_ for id_ in ids if id_ is not None})
+    if not ids:
+        return {}
+    filter_dict = dict(filter_dict, id__in=ids)
+    return {str(obj['id']): obj
+            for obj in get_all_results(http_session, endpoint, filter_dict)}